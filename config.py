@@ -24,7 +24,41 @@ def get_database_url():
         f"?client_encoding=utf8&options=-csearch_path%3D{schema_encoded}"
     )
 
+def get_async_database_url():
+    db_user = os.getenv("DB_USER", "postgres")
+    db_password = os.getenv("DB_PASSWORD", "postgres")
+    db_host = os.getenv("DB_HOST", "localhost")
+    db_port = os.getenv("DB_PORT", "5432")
+    db_name = os.getenv("DB_NAME", "finance_db")
+
+    db_password_encoded = urllib.parse.quote_plus(db_password)
+
+    # asyncpg не принимает options/client_encoding в URL, search_path задается в database.py
+    return f"postgresql+asyncpg://{db_user}:{db_password_encoded}@{db_host}:{db_port}/{db_name}"
+
 DATABASE_URL = os.getenv("DATABASE_URL", get_database_url())
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", get_async_database_url())
+DB_SCHEMA = os.getenv("DB_SCHEMA", "finance")
+
+# Параметры пула соединений SQLAlchemy
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))
+
+# За PgBouncer (pool_mode=transaction, обычно порт 6432) пулом соединений управляет он:
+# приложение не держит свой пул и не использует prepared statements.
+# search_path в этом режиме задается на стороне БД (ALTER ROLE ... SET search_path),
+# а PgBouncer должен игнорировать стартовые параметры (ignore_startup_parameters)
+DB_USE_PGBOUNCER = os.getenv("DB_USE_PGBOUNCER", "false").lower() in ("1", "true", "yes")
+
+# Применять migrations.py при старте приложения. Для нескольких воркеров удобнее
+# выполнять python migrations.py отдельным шагом деплоя и выключить этот флаг
+DB_MIGRATE_ON_STARTUP = os.getenv("DB_MIGRATE_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+
+# Период фонового обновления материализованных представлений (matviews.py), секунды.
+# 0 - без фоновой задачи, обновление запускается отдельно: python matviews.py
+MATVIEW_REFRESH_INTERVAL = int(os.getenv("MATVIEW_REFRESH_INTERVAL", "60"))
 
 # Other configurations can go here
 # e.g., API_PREFIX = "/api"
\ No newline at end of file
@@ -1,15 +1,32 @@
+from uuid import uuid4
+
 from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from config import DATABASE_URL
+from config import (
+    DATABASE_URL, ASYNC_DATABASE_URL, DB_SCHEMA, DB_POOL_SIZE, DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_USE_PGBOUNCER
+)
+
+if DB_USE_PGBOUNCER:
+    # Соединения пулит PgBouncer, у приложения пула нет
+    pool_options = {"poolclass": NullPool}
+else:
+    pool_options = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE
+    }
 
 # Создаем engine с дополнительными параметрами
 try:
     engine = create_engine(
         DATABASE_URL,
         pool_pre_ping=True,
-        pool_size=5,
-        max_overflow=10,
+        **pool_options,
         connect_args={
             "client_encoding": "utf8",
             "connect_timeout": 10
@@ -24,3 +41,25 @@ except Exception as e:
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()  # Keep Base here for potential ORM routers in db_models.py
+
+# Асинхронный engine (asyncpg) для роутеров, переведенных на AsyncSession
+async_connect_args = {"timeout": 10}
+if DB_USE_PGBOUNCER:
+    # transaction pooling не сохраняет состояние сессии, поэтому без кэша prepared statements.
+    # asyncpg все равно именует запросы счетчиком своего соединения; уникальные имена исключают
+    # "prepared statement already exists", когда соединение с сервером делят клиенты
+    async_connect_args.update(
+        statement_cache_size=0,
+        prepared_statement_cache_size=0,
+        prepared_statement_name_func=lambda: f"__asyncpg_{uuid4()}__"
+    )
+else:
+    async_connect_args["server_settings"] = {"search_path": DB_SCHEMA}
+
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_pre_ping=True,
+    **pool_options,
+    connect_args=async_connect_args
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
@@ -1,4 +1,4 @@
-from database import SessionLocal
+from database import SessionLocal, AsyncSessionLocal
 
 
 # Dependency для получения сессии БД
@@ -8,3 +8,9 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+# Dependency для асинхронной сессии БД
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,8 +1,13 @@
+import asyncio
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from routers import categories, accounts, transactions, budgets, tags, savings_goals, recurring_transactions, data_ops
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, ORJSONResponse
+from migrations import apply_migrations
+from matviews import refresh_materialized_views_periodically
+from config import DB_MIGRATE_ON_STARTUP, MATVIEW_REFRESH_INTERVAL
 
 # Импортируем улучшенную аналитику
 from routers.analytics import router as analytics_router
@@ -10,7 +15,8 @@ from routers.analytics import router as analytics_router
 app = FastAPI(
     title="Personal Finance Tracker",
     version="2.1.0",
-    description="Улучшенный трекер личных финансов с умной аналитикой"
+    description="Улучшенный трекер личных финансов с умной аналитикой",
+    default_response_class=ORJSONResponse
 )
 
 # CORS для фронтенда
@@ -20,6 +26,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Include routers
@@ -33,6 +40,28 @@ app.include_router(savings_goals.router, prefix="/api")  # /api/savings-goals
 app.include_router(recurring_transactions.router, prefix="/api")  # /api/recurring-transactions
 app.include_router(data_ops.router, prefix="/api")  # /api/data
 
+
+@app.on_event("startup")
+def run_migrations():
+    if DB_MIGRATE_ON_STARTUP:
+        apply_migrations()
+
+
+@app.on_event("startup")
+async def start_matview_refresh():
+    if MATVIEW_REFRESH_INTERVAL > 0:
+        app.state.matview_refresh_task = asyncio.create_task(
+            refresh_materialized_views_periodically(MATVIEW_REFRESH_INTERVAL)
+        )
+
+
+@app.on_event("shutdown")
+async def stop_matview_refresh():
+    task = getattr(app.state, "matview_refresh_task", None)
+    if task:
+        task.cancel()
+
+
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
@@ -0,0 +1,48 @@
+import asyncio
+from datetime import timedelta
+
+from sqlalchemy import text
+from database import engine
+
+# Обновление материализованных представлений вне запросов: фоновой задачей приложения
+# (см. main.py, MATVIEW_REFRESH_INTERVAL) или отдельно, например из cron: python matviews.py
+
+# Как часто пересчитывается агрегат peer_comparison_agg
+PEER_METRICS_TTL = timedelta(days=1)
+
+# Обновление ведет один воркер, остальные не ждут его, а пропускают
+TRY_REFRESH_LOCK_QUERY = text("SELECT pg_try_advisory_xact_lock(hashtext(:name))")
+
+PEER_COMPARISON_STALE_QUERY = text("SELECT refreshed_at < now() - :ttl FROM peer_comparison_agg")
+
+
+def refresh_peer_comparison():
+    """Пересчитывает peer_comparison_agg раз в PEER_METRICS_TTL"""
+    with engine.begin() as conn:
+        if not conn.execute(TRY_REFRESH_LOCK_QUERY, {"name": "peer_comparison_agg"}).scalar():
+            return
+        if conn.execute(PEER_COMPARISON_STALE_QUERY, {"ttl": PEER_METRICS_TTL}).scalar():
+            conn.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY peer_comparison_agg"))
+
+
+MATVIEW_REFRESHERS = [refresh_peer_comparison]
+
+
+def refresh_materialized_views():
+    """Обновляет все представления; ошибка одного не мешает остальным"""
+    for refresh in MATVIEW_REFRESHERS:
+        try:
+            refresh()
+        except Exception as e:
+            print(f"❌ Materialized view refresh error ({refresh.__name__}): {e}")
+
+
+async def refresh_materialized_views_periodically(interval: int):
+    """Фоновая задача: синхронный engine работает в отдельном потоке, не блокируя event loop"""
+    while True:
+        await asyncio.to_thread(refresh_materialized_views)
+        await asyncio.sleep(interval)
+
+
+if __name__ == "__main__":
+    refresh_materialized_views()
@@ -0,0 +1,232 @@
+import hashlib
+
+from sqlalchemy import text
+from database import engine
+
+# Идемпотентные изменения схемы. Примененные отмечаются в schema_migrations по
+# контрольной сумме текста, поэтому каждая выполняется один раз (или заново после правки).
+# Сама схема БД живет вне репозитория, поэтому здесь только операции IF [NOT] EXISTS.
+MIGRATIONS = [
+    # Дата последней созданной транзакции для регулярных платежей
+    "ALTER TABLE recurring_transactions ADD COLUMN IF NOT EXISTS last_created_date DATE",
+    # get_upcoming_bills: активные регулярные расходы, отфильтрованные по end_date
+    """
+    CREATE INDEX IF NOT EXISTS idx_recurring_active
+    ON recurring_transactions (end_date)
+    INCLUDE (name, amount, frequency, start_date)
+    WHERE is_active = true AND type = 'expense'
+    """,
+    # peer-comparison: средние за последние 3 месяца и за предыдущие 9 месяцев.
+    # Пересчитывается фоновой задачей, когда данные устаревают (matviews.py, PEER_METRICS_TTL)
+    """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS peer_comparison_agg AS
+    SELECT
+        1 AS id,
+        u.avg_expense AS your_expense,
+        u.avg_income AS your_income,
+        p.avg_expense AS peer_expense,
+        p.avg_income AS peer_income,
+        now() AS refreshed_at
+    FROM (
+        SELECT
+            AVG(CASE WHEN type = 'expense' THEN amount ELSE 0 END) AS avg_expense,
+            AVG(CASE WHEN type = 'income' THEN amount ELSE 0 END) AS avg_income
+        FROM transactions
+        WHERE date >= CURRENT_DATE - INTERVAL '3 months'
+    ) u, (
+        SELECT
+            AVG(CASE WHEN type = 'expense' THEN amount ELSE 0 END) AS avg_expense,
+            AVG(CASE WHEN type = 'income' THEN amount ELSE 0 END) AS avg_income
+        FROM transactions
+        WHERE date >= CURRENT_DATE - INTERVAL '12 months'
+          AND date < CURRENT_DATE - INTERVAL '3 months'
+    ) p
+    """,
+    # Уникальный индекс нужен для REFRESH MATERIALIZED VIEW CONCURRENTLY
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_peer_comparison_agg_id
+    ON peer_comparison_agg (id)
+    """,
+    # search_transactions: выборки кандидатов по счетам/категориям и сортировка по дате
+    "CREATE INDEX IF NOT EXISTS idx_transactions_category_date ON transactions (category_id, date DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_subcategory_date ON transactions (subcategory_id, date DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_account_from_date ON transactions (account_from_id, date DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_account_to_date ON transactions (account_to_id, date DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_date_time ON transactions (date DESC, time DESC)",
+    # Теги транзакции собираются LATERAL-подзапросом по transaction_id
+    "CREATE INDEX IF NOT EXISTS idx_transaction_tags_transaction ON transaction_tags (transaction_id) INCLUDE (tag_id)",
+    # Фильтр по тегам в search_transactions и проверка использования в delete_tag
+    "CREATE INDEX IF NOT EXISTS idx_transaction_tags_tag ON transaction_tags (tag_id) INCLUDE (transaction_id)",
+    # Keyset-пагинация списка транзакций: (date, id) < курсор
+    "CREATE INDEX IF NOT EXISTS idx_transactions_date_id ON transactions (date DESC, id DESC)",
+    # create_transaction: вставка, теги и балансы за один вызов
+    """
+    CREATE OR REPLACE FUNCTION create_transaction_fn(
+        p_date date,
+        p_type varchar,
+        p_amount numeric,
+        p_from int,
+        p_to int,
+        p_cat int,
+        p_sub int,
+        p_desc text,
+        p_notes text,
+        p_planned boolean,
+        p_tag_ids int[]
+    ) RETURNS transactions
+    LANGUAGE plpgsql AS $$
+    DECLARE
+        v_row transactions;
+    BEGIN
+        INSERT INTO transactions (
+            date, type, amount, account_from_id, account_to_id,
+            category_id, subcategory_id, description, notes, is_planned
+        ) VALUES (
+            p_date, p_type, p_amount, p_from, p_to,
+            p_cat, p_sub, p_desc, p_notes, p_planned
+        ) RETURNING * INTO v_row;
+
+        INSERT INTO transaction_tags (transaction_id, tag_id)
+        SELECT v_row.id, unnest(p_tag_ids);
+
+        UPDATE accounts a
+        SET current_balance = a.current_balance + d.delta, updated_at = CURRENT_TIMESTAMP
+        FROM (
+            SELECT id, SUM(delta) AS delta
+            FROM (VALUES (p_from, -p_amount), (p_to, p_amount)) AS v(id, delta)
+            WHERE id IS NOT NULL
+            GROUP BY id
+        ) d
+        WHERE a.id = d.id;
+
+        RETURN v_row;
+    END;
+    $$
+    """,
+    # Представление transactions_enriched с флагом устаревания и триггерами убрано:
+    # списки и поиск читают живые таблицы. Функция удаляется вместе с триггерами (CASCADE),
+    # представление - вместе со своими индексами
+    "DROP FUNCTION IF EXISTS mark_transactions_enriched_dirty() CASCADE",
+    "DROP TABLE IF EXISTS matview_state",
+    "DROP MATERIALIZED VIEW IF EXISTS transactions_enriched",
+    # ILIKE '%...%' по индексу в search_transactions и routers/data_ops.py, аналитика по типам
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_text_trgm ON transactions USING GIN (description gin_trgm_ops, notes gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_type_date ON transactions (type, date DESC)",
+    # create_tag: уникальность имени тега без учета регистра для ON CONFLICT.
+    # Импорт раньше создавал теги, отличающиеся только регистром: они сливаются
+    # в тег с наименьшим id (вместе со связями) в той же транзакции, что и индекс
+    """
+    WITH dups AS (
+        SELECT id, keep_id
+        FROM (SELECT id, min(id) OVER (PARTITION BY lower(name)) AS keep_id FROM tags) ranked
+        WHERE id <> keep_id
+    ),
+    moved AS (
+        INSERT INTO transaction_tags (transaction_id, tag_id)
+        SELECT DISTINCT tt.transaction_id, d.keep_id
+        FROM transaction_tags tt
+        JOIN dups d ON d.id = tt.tag_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM transaction_tags k
+            WHERE k.transaction_id = tt.transaction_id AND k.tag_id = d.keep_id
+        )
+    ),
+    unlinked AS (
+        DELETE FROM transaction_tags WHERE tag_id IN (SELECT id FROM dups)
+    )
+    DELETE FROM tags WHERE id IN (SELECT id FROM dups);
+    CREATE UNIQUE INDEX IF NOT EXISTS tags_lower_name_uidx ON tags (lower(name))
+    """,
+    # Списки бюджетов и категорий по умолчанию показывают только активные записи
+    "CREATE INDEX IF NOT EXISTS idx_budgets_active_start ON budgets (start_date DESC) WHERE is_active",
+    "CREATE INDEX IF NOT EXISTS idx_categories_active_type_name ON categories (type, name) WHERE is_active",
+    "CREATE INDEX IF NOT EXISTS idx_categories_active_parent ON categories (parent_id) WHERE is_active",
+    # Категория пополнения целей создается через ON CONFLICT (routers/savings_goals.py).
+    # Раньше она могла создаться несколько раз: дубликаты сливаются в категорию
+    # с наименьшим id в той же транзакции, что и индекс
+    """
+    WITH dups AS (
+        SELECT id, keep_id
+        FROM (
+            SELECT id, min(id) OVER (PARTITION BY type) AS keep_id
+            FROM categories
+            WHERE name = 'Пополнение цели'
+        ) ranked
+        WHERE id <> keep_id
+    ),
+    moved_transactions AS (
+        UPDATE transactions t
+        SET category_id = COALESCE((SELECT keep_id FROM dups WHERE id = t.category_id), t.category_id),
+            subcategory_id = COALESCE((SELECT keep_id FROM dups WHERE id = t.subcategory_id), t.subcategory_id)
+        WHERE t.category_id IN (SELECT id FROM dups) OR t.subcategory_id IN (SELECT id FROM dups)
+    ),
+    moved_budgets AS (
+        UPDATE budgets b SET category_id = d.keep_id FROM dups d WHERE b.category_id = d.id
+    ),
+    moved_recurring AS (
+        UPDATE recurring_transactions r SET category_id = d.keep_id FROM dups d WHERE r.category_id = d.id
+    ),
+    moved_children AS (
+        UPDATE categories c SET parent_id = d.keep_id FROM dups d WHERE c.parent_id = d.id
+    )
+    DELETE FROM categories WHERE id IN (SELECT id FROM dups);
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_categories_savings_deposit
+    ON categories (name, type)
+    WHERE name = 'Пополнение цели'
+    """,
+    # /process-all читает все поля активных повторяющихся транзакций
+    """
+    CREATE INDEX IF NOT EXISTS idx_rt_active_due
+    ON recurring_transactions (id)
+    INCLUDE (name, type, amount, account_from_id, account_to_id, category_id,
+             frequency, start_date, end_date, last_created_date)
+    WHERE is_active = true
+    """,
+]
+
+
+SCHEMA_MIGRATIONS_QUERY = text("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        checksum text PRIMARY KEY,
+        applied_at timestamptz NOT NULL DEFAULT now()
+    )
+""")
+
+# Воркеры, стартующие одновременно, применяют миграции по очереди.
+# Блокировка уровня транзакции, поэтому работает и за PgBouncer
+MIGRATIONS_LOCK_QUERY = text("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'))")
+
+MIGRATION_APPLIED_QUERY = text("SELECT 1 FROM schema_migrations WHERE checksum = :checksum")
+
+RECORD_MIGRATION_QUERY = text("INSERT INTO schema_migrations (checksum) VALUES (:checksum)")
+
+
+def apply_migrations():
+    """
+    Применяет новые миграции, каждую в одной транзакции с отметкой в schema_migrations.
+    Ошибка прерывает запуск: без функций, представлений и индексов из MIGRATIONS
+    зависящие от них эндпоинты все равно отвечали бы 500
+    """
+    with engine.begin() as conn:
+        conn.execute(MIGRATIONS_LOCK_QUERY)
+        conn.execute(SCHEMA_MIGRATIONS_QUERY)
+
+    for statement in MIGRATIONS:
+        checksum = hashlib.md5(statement.encode()).hexdigest()
+        with engine.begin() as conn:
+            conn.execute(MIGRATIONS_LOCK_QUERY)
+            if conn.execute(MIGRATION_APPLIED_QUERY, {"checksum": checksum}).fetchone():
+                continue
+            try:
+                conn.execute(text(statement))
+            except Exception as e:
+                print(f"❌ Migration error: {e}")
+                raise
+            conn.execute(RECORD_MIGRATION_QUERY, {"checksum": checksum})
+
+
+if __name__ == "__main__":
+    # Отдельный шаг деплоя: python migrations.py, затем запуск с DB_MIGRATE_ON_STARTUP=false
+    apply_migrations()
+    print("✅ Migrations applied")
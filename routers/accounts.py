@@ -5,6 +5,8 @@ from sqlalchemy import text
 from dependencies import get_db
 from models.schemas import Account, AccountCreate, AccountUpdate
 from utils.enums import AccountType
+from routers.transactions import search_count_cache
+from routers.categories import categories_cache
 from decimal import Decimal
 
 router = APIRouter(
@@ -153,7 +155,8 @@ def adjust_account_balance(
             text("SELECT id FROM categories WHERE name = 'Корректировка' AND type = 'transfer'")
         ).scalar()
 
-        if not category_id:
+        category_created = not category_id
+        if category_created:
             # Create a default "Adjustment" category if it doesn't exist
             new_cat = db.execute(
                 text("""
@@ -194,6 +197,9 @@ def adjust_account_balance(
         )
 
         trans.commit()
+        search_count_cache.clear()
+        if category_created:
+            categories_cache.clear()
         return {"message": f"Баланс счета {account_id} скорректирован до {new_balance}", "old_balance": current,
                 "new_balance": new_balance, "difference": difference}
 
@@ -4,7 +4,11 @@ from sqlalchemy.orm import Session
 from sqlalchemy import text
 from dependencies import get_db
 from datetime import date, datetime, timedelta
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
+from functools import lru_cache
+from dateutil.relativedelta import relativedelta
+import re
+import random
 import numpy as np
 from collections import defaultdict
 
@@ -13,6 +17,19 @@ router = APIRouter(
     tags=["Behavioral Analytics"]
 )
 
+# Возрастные группы для peer comparison ("56+" - буквальный плюс)
+AGE_GROUP_RE = re.compile(r"^(18-25|26-35|36-45|46-55|56\+)$")
+
+
+# Границы окон анализа считаются в Python и передаются в запросы параметрами,
+# чтобы текст запросов не менялся и план мог переиспользоваться
+def days_ago(days: int) -> date:
+    return date.today() - timedelta(days=days)
+
+
+def months_ago(months: int) -> date:
+    return date.today() - relativedelta(months=months)
+
 
 @router.get("/dashboard-insights")
 async def get_dashboard_insights(db: Session = Depends(get_db)):
@@ -58,18 +75,9 @@ async def predict_cash_flow(db: Session) -> Dict[str, Any]:
                 SUM(CASE WHEN type = 'income' THEN amount ELSE 0 END) as income,
                 SUM(CASE WHEN type = 'expense' THEN amount ELSE 0 END) as expense
             FROM transactions
-            WHERE date >= CURRENT_DATE - INTERVAL '90 days'
+            WHERE date >= :since
             GROUP BY date
         ),
-        patterns AS (
-            SELECT 
-                EXTRACT(DOW FROM date) as day_of_week,
-                AVG(expense) as avg_expense,
-                STDDEV(expense) as stddev_expense,
-                AVG(income) as avg_income
-            FROM daily_flows
-            GROUP BY EXTRACT(DOW FROM date)
-        ),
         monthly_trend AS (
             SELECT 
                 date_trunc('month', date) as month,
@@ -77,17 +85,15 @@ async def predict_cash_flow(db: Session) -> Dict[str, Any]:
                 SUM(income) as total_income
             FROM daily_flows
             GROUP BY date_trunc('month', date)
-            ORDER BY month
         )
         SELECT 
             (SELECT SUM(current_balance) FROM accounts WHERE is_active = true) as current_balance,
-            (SELECT AVG(avg_expense) FROM patterns) as daily_avg_expense,
-            (SELECT SUM(avg_expense) FROM patterns) as weekly_expense,
+            (SELECT AVG(expense) FROM daily_flows) as daily_avg_expense,
             (SELECT COALESCE(AVG(total_expense), 0) FROM monthly_trend) as monthly_avg_expense,
             (SELECT COALESCE(AVG(total_income), 0) FROM monthly_trend) as monthly_avg_income
     """
 
-    result = db.execute(text(query)).fetchone()
+    result = db.execute(text(query), {"since": days_ago(90)}).fetchone()
 
     current_balance = float(result.current_balance or 0)
     daily_avg = float(result.daily_avg_expense or 0)
@@ -136,25 +142,17 @@ async def analyze_spending_triggers(db: Session) -> Dict[str, Any]:
     query = """
         WITH spending_patterns AS (
             SELECT 
-                t.date,
                 t.amount,
-                t.category_id,
-                c.name as category_name,
-                EXTRACT(DOW FROM t.date) as day_of_week,
-                EXTRACT(HOUR FROM t.created_at) as hour_of_day,
-                LAG(t.date) OVER (ORDER BY t.date) as prev_transaction_date
+                EXTRACT(DOW FROM t.date) as day_of_week
             FROM transactions t
             JOIN categories c ON t.category_id = c.id
             WHERE t.type = 'expense' 
-              AND t.date >= CURRENT_DATE - INTERVAL '30 days'
-            ORDER BY t.date DESC
+              AND t.date >= :since
         ),
         trigger_analysis AS (
             SELECT 
                 day_of_week,
-                COUNT(*) as transaction_count,
                 AVG(amount) as avg_amount,
-                SUM(amount) as total_amount,
                 -- Выходные vs будни
                 CASE 
                     WHEN day_of_week IN (0, 6) THEN 'weekend'
@@ -165,14 +163,12 @@ async def analyze_spending_triggers(db: Session) -> Dict[str, Any]:
         )
         SELECT 
             day_type,
-            SUM(transaction_count) as transactions,
-            AVG(avg_amount) as avg_transaction,
-            SUM(total_amount) as total_spent
+            AVG(avg_amount) as avg_transaction
         FROM trigger_analysis
         GROUP BY day_type
     """
 
-    patterns = db.execute(text(query)).fetchall()
+    patterns = db.execute(text(query), {"since": days_ago(30)}).fetchall()
 
     # Анализ импульсивных покупок
     impulse_query = """
@@ -181,7 +177,7 @@ async def analyze_spending_triggers(db: Session) -> Dict[str, Any]:
             SUM(amount) as impulse_total
         FROM transactions t
         WHERE type = 'expense'
-          AND date >= CURRENT_DATE - INTERVAL '30 days'
+          AND date >= :since
           AND (
               -- Мелкие частые траты
               (amount < 500 AND category_id IN (
@@ -193,7 +189,7 @@ async def analyze_spending_triggers(db: Session) -> Dict[str, Any]:
           )
     """
 
-    impulse_result = db.execute(text(impulse_query)).fetchone()
+    impulse_result = db.execute(text(impulse_query), {"since": days_ago(30)}).fetchone()
 
     triggers = {
         "weekend_overspending": False,
@@ -247,23 +243,23 @@ async def calculate_savings_momentum(db: Session) -> Dict[str, Any]:
     """
     Рассчитывает momentum сбережений с gamification элементами
     """
+    # Один проход по транзакциям: дневные итоги за 6 месяцев служат
+    # и для помесячных сбережений, и для серии положительных дней
     query = """
-        WITH monthly_savings AS (
+        WITH daily_net AS (
             SELECT 
-                date_trunc('month', date) as month,
-                SUM(CASE WHEN type = 'income' THEN amount ELSE -amount END) as net_savings
+                date,
+                SUM(CASE WHEN type = 'income' THEN amount ELSE -amount END) as daily_net
             FROM transactions
-            WHERE date >= CURRENT_DATE - INTERVAL '6 months'
-            GROUP BY date_trunc('month', date)
-            ORDER BY month
+            WHERE date >= :since_6m
+            GROUP BY date
         ),
-        savings_trend AS (
+        monthly_savings AS (
             SELECT 
-                month,
-                net_savings,
-                LAG(net_savings) OVER (ORDER BY month) as prev_month,
-                AVG(net_savings) OVER (ORDER BY month ROWS BETWEEN 2 PRECEDING AND CURRENT ROW) as moving_avg
-            FROM monthly_savings
+                date_trunc('month', date) as month,
+                SUM(daily_net) as net_savings
+            FROM daily_net
+            GROUP BY date_trunc('month', date)
         )
         SELECT 
             COALESCE(AVG(net_savings), 0) as avg_monthly_savings,
@@ -271,12 +267,21 @@ async def calculate_savings_momentum(db: Session) -> Dict[str, Any]:
             COUNT(CASE WHEN net_savings > 0 THEN 1 END) as positive_months,
             COUNT(*) as total_months,
             MAX(net_savings) as best_month,
-            MIN(net_savings) as worst_month
-        FROM savings_trend
-        WHERE month >= CURRENT_DATE - INTERVAL '3 months'
+            (
+                SELECT COUNT(*) FILTER (
+                    WHERE daily_net >= 0 AND date >= :since_30d
+                )
+                FROM daily_net
+            ) as positive_days
+        FROM monthly_savings
+        WHERE month >= :since_3m
     """
 
-    result = db.execute(text(query)).fetchone()
+    result = db.execute(text(query), {
+        "since_6m": months_ago(6),
+        "since_3m": months_ago(3),
+        "since_30d": days_ago(30)
+    }).fetchone()
 
     avg_savings = float(result.avg_monthly_savings or 0)
     consistency = (result.positive_months / result.total_months * 100) if result.total_months > 0 else 0
@@ -291,23 +296,7 @@ async def calculate_savings_momentum(db: Session) -> Dict[str, Any]:
         momentum_score += 30
 
     # Streak calculation
-    streak_query = """
-        WITH daily_balance AS (
-            SELECT 
-                date,
-                SUM(CASE WHEN type = 'income' THEN amount ELSE -amount END) as daily_net
-            FROM transactions
-            WHERE date >= CURRENT_DATE - INTERVAL '30 days'
-            GROUP BY date
-            ORDER BY date DESC
-        )
-        SELECT COUNT(*) as positive_days
-        FROM daily_balance
-        WHERE daily_net >= 0
-    """
-
-    streak_result = db.execute(text(streak_query)).fetchone()
-    current_streak = streak_result.positive_days if streak_result else 0
+    current_streak = result.positive_days or 0
 
     # Gamification elements
     level = "Новичок"
@@ -347,7 +336,7 @@ async def calculate_financial_health_score(db: Session) -> Dict[str, Any]:
                 AVG(CASE WHEN type = 'income' THEN amount ELSE 0 END) as avg_income,
                 AVG(CASE WHEN type = 'expense' THEN amount ELSE 0 END) as avg_expense
             FROM transactions
-            WHERE date >= CURRENT_DATE - INTERVAL '3 months'
+            WHERE date >= :since
         ),
         emergency_fund AS (
             SELECT 
@@ -356,7 +345,6 @@ async def calculate_financial_health_score(db: Session) -> Dict[str, Any]:
             WHERE name ILIKE '%резерв%' OR name ILIKE '%emergency%'
         )
         SELECT 
-            a.total_balance,
             a.active_accounts,
             m.avg_income,
             m.avg_expense,
@@ -368,7 +356,7 @@ async def calculate_financial_health_score(db: Session) -> Dict[str, Any]:
         FROM account_data a, monthly_data m, emergency_fund e
     """
 
-    result = db.execute(text(metrics_query)).fetchone()
+    result = db.execute(text(metrics_query), {"since": months_ago(3)}).fetchone()
 
     # Расчет health score (0-100)
     health_score = 0
@@ -421,7 +409,7 @@ async def calculate_financial_health_score(db: Session) -> Dict[str, Any]:
                                              result.avg_income - result.avg_expense) / result.avg_income * 100) if result and result.avg_income > 0 else 0,
             "account_diversification": result.active_accounts if result else 0
         },
-        "improvements_needed": get_health_improvements(health_score, months_covered)
+        "improvements_needed": list(get_health_improvements(health_score, int(months_covered)))
     }
 
 
@@ -494,19 +482,19 @@ async def get_upcoming_bills(db: Session) -> List[Dict[str, Any]]:
             frequency,
             CASE 
                 WHEN frequency = 'monthly' THEN 
-                    date_trunc('month', CURRENT_DATE) + interval '1 month' - 
-                    (date_trunc('month', CURRENT_DATE) - date_trunc('month', start_date))
-                ELSE CURRENT_DATE + interval '7 days'
+                    date_trunc('month', CAST(:today AS date)) + interval '1 month' - 
+                    (date_trunc('month', CAST(:today AS date)) - date_trunc('month', start_date))
+                ELSE CAST(:today AS date) + interval '7 days'
             END as next_due_date
         FROM recurring_transactions
         WHERE is_active = true 
           AND type = 'expense'
-          AND (end_date IS NULL OR end_date > CURRENT_DATE)
+          AND (end_date IS NULL OR end_date > :today)
         ORDER BY next_due_date
         LIMIT 5
     """
 
-    results = db.execute(text(query)).fetchall()
+    results = db.execute(text(query), {"today": date.today()}).fetchall()
 
     return [
         {
@@ -519,6 +507,7 @@ async def get_upcoming_bills(db: Session) -> List[Dict[str, Any]]:
     ]
 
 
+@lru_cache(maxsize=1024)
 def get_motivation_message(score: int, streak: int) -> str:
     """Генерирует мотивационное сообщение на основе прогресса"""
     if score >= 80:
@@ -531,8 +520,13 @@ def get_motivation_message(score: int, streak: int) -> str:
         return "Начните с малого - сэкономьте 100₸ сегодня. Вы можете это! 💡"
 
 
-def get_health_improvements(score: int, months_covered: float) -> List[str]:
-    """Предлагает конкретные улучшения для финансового здоровья"""
+@lru_cache(maxsize=1024)
+def get_health_improvements(score: int, months_covered: int) -> Tuple[str, ...]:
+    """
+    Предлагает конкретные улучшения для финансового здоровья.
+    months_covered передается целым числом месяцев, чтобы результат кэшировался;
+    возвращается кортеж, так как закэшированное значение разделяется между вызовами
+    """
     improvements = []
 
     if months_covered < 3:
@@ -544,7 +538,7 @@ def get_health_improvements(score: int, months_covered: float) -> List[str]:
     if len(improvements) == 0:
         improvements.append("Рассмотрите инвестиционные возможности")
 
-    return improvements
+    return tuple(improvements)
 
 
 # Micro-feedback notifications endpoint
@@ -559,19 +553,11 @@ async def get_spending_notifications(db: Session = Depends(get_db)):
         WITH today_spending AS (
             SELECT 
                 SUM(amount) as total_today,
-                COUNT(*) as transaction_count,
-                MAX(amount) as largest_transaction,
-                array_agg(
-                    json_build_object(
-                        'amount', amount,
-                        'category', c.name,
-                        'time', t.created_at
-                    ) ORDER BY amount DESC
-                ) as transactions
+                COUNT(*) as transaction_count
             FROM transactions t
             JOIN categories c ON t.category_id = c.id
             WHERE t.type = 'expense' 
-              AND t.date = CURRENT_DATE
+              AND t.date = :today
         ),
         daily_average AS (
             SELECT AVG(daily_total) as avg_daily
@@ -579,8 +565,8 @@ async def get_spending_notifications(db: Session = Depends(get_db)):
                 SELECT date, SUM(amount) as daily_total
                 FROM transactions
                 WHERE type = 'expense' 
-                  AND date >= CURRENT_DATE - INTERVAL '30 days'
-                  AND date < CURRENT_DATE
+                  AND date >= :since
+                  AND date < :today
                 GROUP BY date
             ) d
         ),
@@ -597,8 +583,6 @@ async def get_spending_notifications(db: Session = Depends(get_db)):
         SELECT 
             t.total_today,
             t.transaction_count,
-            t.largest_transaction,
-            t.transactions,
             d.avg_daily,
             (
                 SELECT json_agg(
@@ -610,7 +594,7 @@ async def get_spending_notifications(db: Session = Depends(get_db)):
                              FROM transactions 
                              WHERE category_id = cl.category_id 
                                AND type = 'expense' 
-                               AND date = CURRENT_DATE), 0
+                               AND date = :today), 0
                         )
                     )
                 )
@@ -619,7 +603,7 @@ async def get_spending_notifications(db: Session = Depends(get_db)):
         FROM today_spending t, daily_average d
     """
 
-    result = db.execute(text(today_query)).fetchone()
+    result = db.execute(text(today_query), {"today": date.today(), "since": days_ago(30)}).fetchone()
 
     notifications = []
 
@@ -665,74 +649,46 @@ async def get_spending_notifications(db: Session = Depends(get_db)):
 
 
 def format_money(amount: float) -> str:
-    """Форматирование денег"""
-    return f"{amount:,.0f}₸"
+    """Форматирование денег: целые тенге с неразрывным пробелом между разрядами"""
+    return format(round(amount), ',d').replace(',', '\u00a0') + '₸'
 
 
 # Добавляем endpoint для peer comparison (анонимное сравнение)
 @router.get("/peer-comparison")
-async def get_peer_comparison(
-        age_group: Optional[str] = Query(None, regex="^(18-25|26-35|36-45|46-55|56+)$"),
+def get_peer_comparison(
+        age_group: Optional[str] = Query(None, pattern=AGE_GROUP_RE.pattern),
         db: Session = Depends(get_db)
 ):
     """
     Анонимное сравнение с похожими пользователями
     (в реальном приложении это было бы сравнение между пользователями)
     """
-    # Для демо используем исторические данные с разными периодами
-    comparison_query = """
-        WITH user_metrics AS (
-            SELECT 
-                AVG(CASE WHEN type = 'expense' THEN amount ELSE 0 END) as avg_expense,
-                AVG(CASE WHEN type = 'income' THEN amount ELSE 0 END) as avg_income,
-                COUNT(DISTINCT date_trunc('month', date)) as months
-            FROM transactions
-            WHERE date >= CURRENT_DATE - INTERVAL '3 months'
-        ),
-        -- Симулируем данные "других пользователей" используя исторические периоды
-        peer_metrics AS (
-            SELECT 
-                AVG(CASE WHEN type = 'expense' THEN amount ELSE 0 END) * (0.8 + random() * 0.4) as avg_expense,
-                AVG(CASE WHEN type = 'income' THEN amount ELSE 0 END) * (0.9 + random() * 0.2) as avg_income
-            FROM transactions
-            WHERE date >= CURRENT_DATE - INTERVAL '12 months'
-              AND date < CURRENT_DATE - INTERVAL '3 months'
-        )
-        SELECT 
-            u.avg_expense as your_expense,
-            u.avg_income as your_income,
-            p.avg_expense as peer_expense,
-            p.avg_income as peer_income,
-            CASE 
-                WHEN u.avg_income > 0 THEN 
-                    ((u.avg_income - u.avg_expense) / u.avg_income * 100)
-                ELSE 0 
-            END as your_savings_rate,
-            CASE 
-                WHEN p.avg_income > 0 THEN 
-                    ((p.avg_income - p.avg_expense) / p.avg_income * 100)
-                ELSE 0 
-            END as peer_savings_rate
-        FROM user_metrics u, peer_metrics p
-    """
-
-    result = db.execute(text(comparison_query)).fetchone()
+    # Для демо "других пользователей" симулируем историческими периодами.
+    # Средние предрасчитаны в peer_comparison_agg (обновляет matviews.py); запрос читает одну строку
+    result = db.execute(text("SELECT * FROM peer_comparison_agg")).fetchone()
 
     if not result:
         return {"message": "Недостаточно данных для сравнения"}
 
-    your_savings_rate = float(result.your_savings_rate or 0)
-    peer_savings_rate = float(result.peer_savings_rate or 15)  # Default 15%
+    your_expense = float(result.your_expense or 0)
+    your_income = float(result.your_income or 0)
+    # Разброс "других пользователей" добавляется здесь, чтобы агрегат оставался кэшируемым
+    peer_expense = float(result.peer_expense or 0) * random.uniform(0.8, 1.2)
+    peer_income = float(result.peer_income or 0) * random.uniform(0.9, 1.1)
+
+    your_savings_rate = (your_income - your_expense) / your_income * 100 if your_income > 0 else 0
+    peer_savings_rate = (peer_income - peer_expense) / peer_income * 100 if peer_income > 0 else 0
+    peer_savings_rate = peer_savings_rate or 15  # Default 15%
 
     comparison = {
         "your_metrics": {
-            "monthly_expense": float(result.your_expense or 0) * 30,
-            "monthly_income": float(result.your_income or 0) * 30,
+            "monthly_expense": your_expense * 30,
+            "monthly_income": your_income * 30,
             "savings_rate": your_savings_rate
         },
         "peer_average": {
-            "monthly_expense": float(result.peer_expense or 0) * 30,
-            "monthly_income": float(result.peer_income or 0) * 30,
+            "monthly_expense": peer_expense * 30,
+            "monthly_income": peer_income * 30,
             "savings_rate": peer_savings_rate
         },
         "insights": []
@@ -1,23 +1,99 @@
 from fastapi import APIRouter, Depends, HTTPException
 from typing import List, Dict, Any, Optional
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
-from dependencies import get_db
+from dependencies import get_async_db
+from utils.sql import build_update_query
 from models.schemas import Budget, BudgetCreate, BudgetUpdate
 from utils.enums import BudgetPeriod
 from datetime import date, datetime, timedelta
 from decimal import Decimal
+from functools import lru_cache
 
 router = APIRouter(
     prefix="/budgets",
     tags=["Budgets"]
 )
 
+# Границы текущего периода считаются в SQL (та же логика, что в
+# calculate_budget_period_dates), потраченная сумма - одним JOIN без N+1
+BUDGETS_LIST_SQL = """
+    SELECT
+        b.*,
+        c.name as category_name,
+        c.icon as category_icon,
+        c.color as category_color,
+        bp.period_start,
+        bp.period_end,
+        COALESCE(SUM(t.amount), 0)::float as spent_amount,
+        CASE WHEN b.amount > 0
+            THEN ROUND(COALESCE(SUM(t.amount), 0) / b.amount * 100, 1)::float
+            ELSE 0
+        END as usage_percentage
+    FROM budgets b
+    -- Начало текущей недели бюджета считается один раз и переиспользуется ниже
+    CROSS JOIN LATERAL (
+        SELECT
+            CAST(:today AS date) as today,
+            b.start_date + CAST(FLOOR((CAST(:today AS date) - b.start_date) / 7.0) AS int) * 7 as week_start
+    ) d
+    CROSS JOIN LATERAL (
+        SELECT
+            CASE b.period
+                WHEN 'daily' THEN d.today
+                WHEN 'weekly' THEN d.week_start
+                WHEN 'monthly' THEN CAST(date_trunc('month', d.today) AS date)
+                WHEN 'quarterly' THEN CAST(date_trunc('quarter', d.today) AS date)
+                WHEN 'yearly' THEN CAST(date_trunc('year', d.today) AS date)
+                ELSE CAST(date_trunc('month', d.today) AS date)
+            END as period_start,
+            CASE b.period
+                WHEN 'daily' THEN d.today
+                WHEN 'weekly' THEN LEAST(d.week_start + 6, d.today)
+                WHEN 'monthly' THEN CAST(date_trunc('month', d.today) + INTERVAL '1 month - 1 day' AS date)
+                WHEN 'quarterly' THEN CAST(date_trunc('quarter', d.today) + INTERVAL '3 months - 1 day' AS date)
+                WHEN 'yearly' THEN CAST(date_trunc('year', d.today) + INTERVAL '1 year - 1 day' AS date)
+                ELSE d.today
+            END as period_end
+    ) bp
+    LEFT JOIN categories c ON b.category_id = c.id
+    LEFT JOIN transactions t ON t.category_id = b.category_id
+        AND t.type = 'expense'
+        AND t.date BETWEEN bp.period_start AND bp.period_end
+    {active_filter}
+    GROUP BY b.id, c.id, bp.period_start, bp.period_end
+    ORDER BY b.start_date DESC
+"""
+BUDGETS_LIST_ALL_QUERY = text(BUDGETS_LIST_SQL.format(active_filter=""))
+BUDGETS_LIST_ACTIVE_QUERY = text(BUDGETS_LIST_SQL.format(active_filter="WHERE b.is_active = true"))
+
+INSERT_BUDGET_QUERY = text("""
+    INSERT INTO budgets (name, category_id, amount, period, start_date, end_date, is_active)
+    VALUES (:name, :category_id, :amount, :period, :start_date, :end_date, :is_active)
+    RETURNING *
+""")
+BUDGET_INSERT_FIELDS = ('name', 'category_id', 'amount', 'period', 'start_date', 'end_date', 'is_active')
+DELETE_BUDGET_QUERY = text("DELETE FROM budgets WHERE id = :id RETURNING id")
+SELECT_BUDGET_QUERY = text("SELECT * FROM budgets WHERE id = :id")
+SELECT_CATEGORY_QUERY = text("SELECT name, icon, color FROM categories WHERE id = :id")
+SPENT_QUERY = text("""
+    SELECT COALESCE(SUM(amount), 0) as total_spent
+    FROM transactions
+    WHERE category_id = :category_id
+      AND type = 'expense'
+      AND date >= :start_date
+      AND date <= :end_date
+""")
+
 
 def calculate_budget_period_dates(budget_period: str, start_date: date) -> tuple[date, date]:
     """Calculate the current period dates based on budget period type."""
-    today = date.today()
+    return _period_dates(budget_period, start_date, date.today())
+
 
+# today входит в ключ кэша, поэтому со сменой дня записи перестают совпадать
+@lru_cache(maxsize=512)
+def _period_dates(budget_period: str, start_date: date, today: date) -> tuple[date, date]:
     if budget_period == 'daily':
         return today, today
     elif budget_period == 'weekly':
@@ -57,126 +133,63 @@ def calculate_budget_period_dates(budget_period: str, start_date: date) -> tuple
 
 
 @router.get("/", response_model=List[Dict[str, Any]])
-def get_budgets(
+async def get_budgets(
         include_inactive: bool = False,
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_async_db)
 ):
-    query = """
-        SELECT
-            b.*,
-            c.name as category_name,
-            c.icon as category_icon,
-            c.color as category_color
-        FROM budgets b
-        LEFT JOIN categories c ON b.category_id = c.id
-        WHERE 1=1
-    """
-    params = {}
-    if not include_inactive:
-        query += " AND b.is_active = true"
-    query += " ORDER BY b.start_date DESC"
-
-    result = db.execute(text(query), params)
-    budgets = [dict(row._asdict()) for row in result]
-
-    # Calculate spent amount for each budget
-    for budget in budgets:
-        period_start, period_end = calculate_budget_period_dates(budget['period'], budget['start_date'])
-
-        spent_query = """
-            SELECT COALESCE(SUM(amount), 0) as spent
-            FROM transactions
-            WHERE category_id = :category_id
-              AND type = 'expense'
-              AND date >= :start_date
-              AND date <= :end_date
-        """
-
-        spent_result = db.execute(text(spent_query), {
-            'category_id': budget['category_id'],
-            'start_date': period_start,
-            'end_date': period_end
-        }).fetchone()
-
-        budget['spent_amount'] = float(spent_result.spent) if spent_result else 0
-        budget['usage_percentage'] = round((budget['spent_amount'] / float(budget['amount']) * 100), 1) if budget[
-                                                                                                               'amount'] > 0 else 0
-        budget['period_start'] = period_start
-        budget['period_end'] = period_end
-
-    return budgets
+    query = BUDGETS_LIST_ALL_QUERY if include_inactive else BUDGETS_LIST_ACTIVE_QUERY
+    result = await db.execute(query, {"today": date.today()})
+    return result.mappings().all()
 
 
 @router.post("/", response_model=Budget)
-def create_budget(budget: BudgetCreate, db: Session = Depends(get_db)):
+async def create_budget(budget: BudgetCreate, db: AsyncSession = Depends(get_async_db)):
     # Set start_date to current date if not provided
     if not hasattr(budget, 'start_date') or not budget.start_date:
         budget.start_date = date.today()
 
-    query = """
-        INSERT INTO budgets (name, category_id, amount, period, start_date, end_date, is_active)
-        VALUES (:name, :category_id, :amount, :period, :start_date, :end_date, :is_active)
-        RETURNING *
-    """
-    params = budget.model_dump()
-    result = db.execute(text(query), params)
-    db.commit()
-    return dict(result.fetchone()._asdict())
+    params = {field: getattr(budget, field) for field in BUDGET_INSERT_FIELDS}
+    result = await db.execute(INSERT_BUDGET_QUERY, params)
+    await db.commit()
+    return result.mappings().one()
 
 
 @router.put("/{budget_id}", response_model=Budget)
-def update_budget(
+async def update_budget(
         budget_id: int,
         budget_update: BudgetUpdate,
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_async_db)
 ):
     update_data = budget_update.model_dump(exclude_unset=True)
     if not update_data:
         raise HTTPException(status_code=400, detail="Нет данных для обновления")
 
-    update_fields = []
-    params = {"id": budget_id}
-
-    for field, value in update_data.items():
-        update_fields.append(f"{field} = :{field}")
-        params[field] = value
+    query = build_update_query("budgets", tuple(update_data), touch_updated_at=True)
+    params = {"id": budget_id, **update_data}
 
-    query = f"""
-        UPDATE budgets
-        SET {', '.join(update_fields)}, updated_at = CURRENT_TIMESTAMP
-        WHERE id = :id
-        RETURNING *
-    """
+    result = await db.execute(query, params)
+    await db.commit()
 
-    result = db.execute(text(query), params)
-    db.commit()
-
-    row = result.fetchone()
+    row = result.mappings().first()
     if not row:
         raise HTTPException(status_code=404, detail="Бюджет не найден")
 
-    return dict(row._asdict())
+    return row
 
 
 @router.delete("/{budget_id}")
-def delete_budget(budget_id: int, db: Session = Depends(get_db)):
-    result = db.execute(
-        text("DELETE FROM budgets WHERE id = :id RETURNING id"),
-        {"id": budget_id}
-    )
+async def delete_budget(budget_id: int, db: AsyncSession = Depends(get_async_db)):
+    result = await db.execute(DELETE_BUDGET_QUERY, {"id": budget_id})
     deleted = result.fetchone()
     if not deleted:
         raise HTTPException(status_code=404, detail="Бюджет не найден")
-    db.commit()
+    await db.commit()
     return {"message": "Бюджет удален"}
 
 
 @router.get("/{budget_id}/summary")
-def get_budget_summary(budget_id: int, db: Session = Depends(get_db)):
-    budget = db.execute(
-        text("SELECT * FROM budgets WHERE id = :id"),
-        {"id": budget_id}
-    ).fetchone()
+async def get_budget_summary(budget_id: int, db: AsyncSession = Depends(get_async_db)):
+    budget = (await db.execute(SELECT_BUDGET_QUERY, {"id": budget_id})).fetchone()
 
     if not budget:
         raise HTTPException(status_code=404, detail="Бюджет не найден")
@@ -187,17 +200,8 @@ def get_budget_summary(budget_id: int, db: Session = Depends(get_db)):
     period_start, period_end = calculate_budget_period_dates(budget.period, budget.start_date)
 
     # Calculate expenses for the budget period and category
-    expenses_query = """
-        SELECT COALESCE(SUM(amount), 0) as total_spent
-        FROM transactions
-        WHERE category_id = :category_id
-          AND type = 'expense'
-          AND date >= :start_date
-          AND date <= :end_date
-    """
-
-    result = db.execute(
-        text(expenses_query),
+    result = await db.execute(
+        SPENT_QUERY,
         {
             "category_id": budget.category_id,
             "start_date": period_start,
@@ -208,10 +212,7 @@ def get_budget_summary(budget_id: int, db: Session = Depends(get_db)):
     total_spent = float(result.scalar() or 0)
 
     # Get category info
-    category = db.execute(
-        text("SELECT name, icon, color FROM categories WHERE id = :id"),
-        {"id": budget.category_id}
-    ).fetchone()
+    category = (await db.execute(SELECT_CATEGORY_QUERY, {"id": budget.category_id})).fetchone()
 
     return {
         "budget": budget_dict,
@@ -1,116 +1,130 @@
 from fastapi import APIRouter, Depends, HTTPException
 from typing import List, Dict, Any, Optional
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
-from dependencies import get_db
+from sqlalchemy.sql.elements import TextClause
+from dependencies import get_async_db
+from utils.sql import build_update_query
 from models.schemas import Category, CategoryCreate, CategoryUpdate
 from utils.enums import TransactionType
+from functools import lru_cache
+from cachetools import TTLCache
 
 router = APIRouter(
     prefix="/categories",
     tags=["Categories"]
 )
 
+CATEGORY_TREE_SQL = """
+    WITH RECURSIVE category_tree AS (
+        SELECT
+            c.id, c.name, c.parent_id, c.type, c.icon, c.color, c.is_active,
+            c.name::text as path,
+            0 as level,
+            c.created_at
+        FROM categories c
+        WHERE c.parent_id IS NULL
+
+        UNION ALL
+
+        SELECT
+            c.id, c.name, c.parent_id, c.type, c.icon, c.color, c.is_active,
+            (ct.path || ' > ' || c.name)::text as path,
+            ct.level + 1 as level,
+            c.created_at
+        FROM categories c
+        JOIN category_tree ct ON c.parent_id = ct.id
+    )
+    SELECT * FROM category_tree
+    WHERE 1=1
+"""
+
+INSERT_CATEGORY_QUERY = text("""
+    INSERT INTO categories (name, parent_id, type, icon, color, is_active)
+    VALUES (:name, :parent_id, :category_type, :icon, :color, :is_active)
+    RETURNING *
+""")
+CATEGORY_INSERT_FIELDS = ('name', 'parent_id', 'icon', 'color', 'is_active')
+COUNT_CATEGORY_TRANSACTIONS_QUERY = text(
+    "SELECT COUNT(*) FROM transactions WHERE category_id = :id OR subcategory_id = :id"
+)
+COUNT_SUBCATEGORIES_QUERY = text("SELECT COUNT(*) FROM categories WHERE parent_id = :id")
+DELETE_CATEGORY_QUERY = text("DELETE FROM categories WHERE id = :id RETURNING id")
+
+# Дерево категорий меняется редко: кэшируем по (category_type, include_inactive)
+# и сбрасываем при любом изменении категорий
+categories_cache = TTLCache(maxsize=16, ttl=60)
+
+
+@lru_cache(maxsize=4)
+def _categories_query(by_type: bool, active_only: bool) -> TextClause:
+    query = CATEGORY_TREE_SQL
+    if by_type:
+        query += " AND type = :type"
+    if active_only:
+        query += " AND is_active = true"
+    query += " ORDER BY type, level, name"
+    return text(query)
+
 
 @router.get("/", response_model=List[Dict[str, Any]])
-def get_categories(
+async def get_categories(
         category_type: Optional[TransactionType] = None,
         include_inactive: bool = False,
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_async_db)
 ):
-    query = """
-        WITH RECURSIVE category_tree AS (
-            SELECT
-                c.id, c.name, c.parent_id, c.type, c.icon, c.color, c.is_active,
-                c.name::text as path,
-                0 as level,
-                c.created_at
-            FROM categories c
-            WHERE c.parent_id IS NULL
-
-            UNION ALL
-
-            SELECT
-                c.id, c.name, c.parent_id, c.type, c.icon, c.color, c.is_active,
-                (ct.path || ' > ' || c.name)::text as path,
-                ct.level + 1 as level,
-                c.created_at
-            FROM categories c
-            JOIN category_tree ct ON c.parent_id = ct.id
-        )
-        SELECT * FROM category_tree
-        WHERE 1=1
-    """
-    params = {}
+    cache_key = (category_type, include_inactive)
+    cached = categories_cache.get(cache_key)
+    if cached is not None:
+        return cached
 
-    if category_type:
-        query += " AND type = :type"
-        params["type"] = category_type.value  # Use .value for Enum to string conversion
+    query = _categories_query(category_type is not None, not include_inactive)
+    params = {"type": category_type.value} if category_type else {}  # Use .value for Enum to string conversion
 
-    if not include_inactive:
-        query += " AND is_active = true"
-
-    query += " ORDER BY type, level, name"
-
-    result = db.execute(text(query), params)
-    return [dict(row._asdict()) for row in result]
+    result = await db.execute(query, params)
+    categories = result.mappings().all()
+    categories_cache[cache_key] = categories
+    return categories
 
 
 @router.post("/", response_model=Category)
-def create_category(category: CategoryCreate, db: Session = Depends(get_db)):
-    query = """
-        INSERT INTO categories (name, parent_id, type, icon, color, is_active)
-        VALUES (:name, :parent_id, :category_type, :icon, :color, :is_active)
-        RETURNING *
-    """
-    params = category.model_dump()
-    params['category_type'] = params.pop('type', None)  # Renaming 'type' to 'category_type' for SQL
-    result = db.execute(text(query), params)
-    db.commit()
-    return dict(result.fetchone()._asdict())
+async def create_category(category: CategoryCreate, db: AsyncSession = Depends(get_async_db)):
+    params = {field: getattr(category, field) for field in CATEGORY_INSERT_FIELDS}
+    params['category_type'] = category.type  # 'type' передается как category_type для SQL
+    result = await db.execute(INSERT_CATEGORY_QUERY, params)
+    await db.commit()
+    categories_cache.clear()
+    return result.mappings().one()
 
 
 @router.put("/{category_id}", response_model=Category)
-def update_category(
+async def update_category(
         category_id: int,
         category_update: CategoryUpdate,
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_async_db)
 ):
     update_data = category_update.model_dump(exclude_unset=True)
     if not update_data:
         raise HTTPException(status_code=400, detail="Нет данных для обновления")
 
-    update_fields = []
-    params = {"id": category_id}
-
-    for field, value in update_data.items():
-        update_fields.append(f"{field} = :{field}")
-        params[field] = value
+    query = build_update_query("categories", tuple(update_data))
+    params = {"id": category_id, **update_data}
 
-    query = f"""
-        UPDATE categories
-        SET {', '.join(update_fields)}
-        WHERE id = :id
-        RETURNING *
-    """
+    result = await db.execute(query, params)
+    await db.commit()
+    categories_cache.clear()
 
-    result = db.execute(text(query), params)
-    db.commit()
-
-    row = result.fetchone()
+    row = result.mappings().first()
     if not row:
         raise HTTPException(status_code=404, detail="Категория не найдена")
 
-    return dict(row._asdict())
+    return row
 
 
 @router.delete("/{category_id}")
-def delete_category(category_id: int, db: Session = Depends(get_db)):
+async def delete_category(category_id: int, db: AsyncSession = Depends(get_async_db)):
     # Проверяем, есть ли транзакции с этой категорией
-    count = db.execute(
-        text("SELECT COUNT(*) FROM transactions WHERE category_id = :id OR subcategory_id = :id"),
-        {"id": category_id}
-    ).scalar()
+    count = (await db.execute(COUNT_CATEGORY_TRANSACTIONS_QUERY, {"id": category_id})).scalar()
 
     if count > 0:
         raise HTTPException(
@@ -119,10 +133,7 @@ def delete_category(category_id: int, db: Session = Depends(get_db)):
         )
 
     # Проверяем, есть ли подкатегории
-    subcount = db.execute(
-        text("SELECT COUNT(*) FROM categories WHERE parent_id = :id"),
-        {"id": category_id}
-    ).scalar()
+    subcount = (await db.execute(COUNT_SUBCATEGORIES_QUERY, {"id": category_id})).scalar()
 
     if subcount > 0:
         raise HTTPException(
@@ -130,12 +141,10 @@ def delete_category(category_id: int, db: Session = Depends(get_db)):
             detail=f"Невозможно удалить категорию. У неё есть {subcount} подкатегорий"
         )
 
-    result = db.execute(
-        text("DELETE FROM categories WHERE id = :id RETURNING id"),
-        {"id": category_id}
-    )
+    result = await db.execute(DELETE_CATEGORY_QUERY, {"id": category_id})
     deleted = result.fetchone()
     if not deleted:
         raise HTTPException(status_code=404, detail="Категория не найдена")
-    db.commit()
+    await db.commit()
+    categories_cache.clear()
     return {"message": "Категория удалена"}
@@ -1,60 +1,163 @@
 from fastapi import APIRouter, Depends, HTTPException, Query, UploadFile, File
 from fastapi.responses import StreamingResponse
-from typing import List, Dict, Any, Optional
-from sqlalchemy.orm import Session
+from typing import List, Dict, Any, Optional, Tuple
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
-from dependencies import get_db
+from sqlalchemy.sql.elements import TextClause
+from dependencies import get_async_db
+from database import AsyncSessionLocal
 from models.schemas import TransactionType
+from routers.categories import categories_cache
+from routers.transactions import search_count_cache
 from datetime import date, datetime
 from decimal import Decimal
+from functools import lru_cache
+import asyncio
 import io
 import csv
 import json
+import orjson
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
 
 router = APIRouter(
     prefix="/data",
     tags=["Data Operations"]
 )
 
+FETCH_TAGS_QUERY = text("""
+    SELECT tt.transaction_id, array_agg(tg.name ORDER BY tg.name) as tags
+    FROM transaction_tags tt
+    JOIN tags tg ON tt.tag_id = tg.id
+    WHERE tt.transaction_id = ANY(:ids)
+    GROUP BY tt.transaction_id
+""")
+
+# Запросы импорта
+CATEGORY_IDS_QUERY = text("SELECT name, id FROM categories")
+ACCOUNT_IDS_QUERY = text("SELECT name, id FROM accounts")
+# Имена тегов уникальны без учета регистра (tags_lower_name_uidx), поэтому ключ - lower(name)
+TAG_IDS_QUERY = text("SELECT lower(name) AS name, id FROM tags")
+TAG_IDS_BY_NAME_QUERY = text("""
+    SELECT lower(name) AS name, id FROM tags WHERE lower(name) = ANY(CAST(:names AS text[]))
+""")
+INSERT_CATEGORIES_QUERY = text("""
+    INSERT INTO categories (name, type, icon, color)
+    SELECT name, type, '📁', '#5e72e4'
+    FROM unnest(CAST(:names AS text[]), CAST(:types AS text[])) AS n(name, type)
+    RETURNING id, name
+""")
+INSERT_TAGS_QUERY = text("""
+    INSERT INTO tags (name)
+    SELECT unnest(CAST(:names AS text[]))
+    ON CONFLICT DO NOTHING
+    RETURNING id, lower(name) AS name
+""")
+# Порядок строк RETURNING не гарантирован, поэтому id выделяются заранее
+# и связи с тегами строятся по ним, а не по позиции в результате INSERT
+ALLOCATE_TRANSACTION_IDS_QUERY = text("""
+    SELECT nextval(pg_get_serial_sequence('transactions', 'id')) AS id
+    FROM generate_series(1, CAST(:count AS int))
+""")
+INSERT_TRANSACTIONS_QUERY = text("""
+    INSERT INTO transactions (
+        id, date, type, amount, account_from_id, account_to_id,
+        category_id, description, notes
+    )
+    SELECT id, date, type, amount, account_from_id, account_to_id,
+           category_id, description, notes
+    FROM unnest(
+        CAST(:ids AS int[]), CAST(:dates AS date[]), CAST(:types AS text[]), CAST(:amounts AS numeric[]),
+        CAST(:account_from_ids AS int[]), CAST(:account_to_ids AS int[]),
+        CAST(:category_ids AS int[]), CAST(:descriptions AS text[]), CAST(:notes AS text[])
+    ) AS r(
+        id, date, type, amount, account_from_id, account_to_id,
+        category_id, description, notes
+    )
+""")
+INSERT_TRANSACTION_TAGS_QUERY = text("""
+    INSERT INTO transaction_tags (transaction_id, tag_id)
+    SELECT unnest(CAST(:tx_ids AS int[])), unnest(CAST(:tag_ids AS int[]))
+    ON CONFLICT DO NOTHING
+""")
+UPDATE_BALANCES_QUERY = text("""
+    UPDATE accounts a
+    SET current_balance = a.current_balance + d.delta,
+        updated_at = CURRENT_TIMESTAMP
+    FROM unnest(CAST(:ids AS int[]), CAST(:deltas AS numeric[])) AS d(id, delta)
+    WHERE a.id = d.id
+""")
+
+
+async def fetch_tags_by_transaction(db: AsyncSession, ids: List[int]) -> Dict[int, List[str]]:
+    """Теги для набора транзакций одним запросом (вместо JOIN + GROUP BY в основном запросе)"""
+    if not ids:
+        return {}
+    result = await db.execute(FETCH_TAGS_QUERY, {"ids": ids})
+    return {row.transaction_id: row.tags for row in result}
+
+
+SEARCH_SELECT_SQL = """
+    SELECT
+        t.*,
+        c.name as category_name,
+        c.icon as category_icon,
+        c.color as category_color,
+        sc.name as subcategory_name,
+        af.name as account_from_name,
+        at.name as account_to_name,
+        COUNT(*) OVER () as total_count
+    FROM transactions t
+"""
+SEARCH_JOINS_SQL = """
+    LEFT JOIN categories c ON t.category_id = c.id
+    LEFT JOIN categories sc ON t.subcategory_id = sc.id
+    LEFT JOIN accounts af ON t.account_from_id = af.id
+    LEFT JOIN accounts at ON t.account_to_id = at.id
+    WHERE 1=1
+"""
+
+
+@lru_cache(maxsize=512)
+def _search_sql_parts(
+        has_q: bool, has_start: bool, has_end: bool, has_min: bool, has_max: bool,
+        has_accounts: bool, has_categories: bool, has_types: bool, has_tags: bool
+) -> Tuple[str, str]:
+    """WITH-часть и соединения с условиями после FROM transactions t; зависят только от набора фильтров"""
+    # Фильтры по счетам и категориям проверяют две колонки. Вместо OR кандидаты
+    # собираются через UNION двух выборок, каждая из которых идет по своему индексу
+    ctes = []
+    if has_accounts:
+        ctes.append("""
+            account_candidates AS (
+                SELECT id FROM transactions WHERE account_from_id = ANY(:account_ids)
+                UNION
+                SELECT id FROM transactions WHERE account_to_id = ANY(:account_ids)
+            )
+        """)
+    if has_categories:
+        ctes.append("""
+            category_candidates AS (
+                SELECT id FROM transactions WHERE category_id = ANY(:category_ids)
+                UNION
+                SELECT id FROM transactions WHERE subcategory_id = ANY(:category_ids)
+            )
+        """)
 
-@router.get("/search/transactions")
-def search_transactions(
-        q: Optional[str] = Query(None, description="Поисковый запрос"),
-        start_date: Optional[date] = None,
-        end_date: Optional[date] = None,
-        min_amount: Optional[Decimal] = None,
-        max_amount: Optional[Decimal] = None,
-        account_ids: Optional[List[int]] = Query(None),
-        category_ids: Optional[List[int]] = Query(None),
-        tag_ids: Optional[List[int]] = Query(None),
-        transaction_types: Optional[List[TransactionType]] = Query(None),
-        limit: int = Query(default=50, le=500),
-        offset: int = 0,
-        db: Session = Depends(get_db)
-):
-    query = """
-        SELECT DISTINCT
-            t.*,
-            c.name as category_name,
-            c.icon as category_icon,
-            c.color as category_color,
-            sc.name as subcategory_name,
-            af.name as account_from_name,
-            at.name as account_to_name,
-            array_agg(DISTINCT tg.name) FILTER (WHERE tg.name IS NOT NULL) as tags
-        FROM transactions t
-        LEFT JOIN categories c ON t.category_id = c.id
-        LEFT JOIN categories sc ON t.subcategory_id = sc.id
-        LEFT JOIN accounts af ON t.account_from_id = af.id
-        LEFT JOIN accounts at ON t.account_to_id = at.id
-        LEFT JOIN transaction_tags tt ON t.id = tt.transaction_id
-        LEFT JOIN tags tg ON tt.tag_id = tg.id
-        WHERE 1=1
-    """
-    params = {"limit": limit, "offset": offset}
+    with_sql = "WITH " + ",".join(ctes) if ctes else ""
+    query = ""
+    if has_accounts:
+        query += " JOIN account_candidates ac ON ac.id = t.id"
+    if has_categories:
+        query += " JOIN category_candidates cc ON cc.id = t.id"
+    query += SEARCH_JOINS_SQL
 
     # Текстовый поиск
-    if q:
+    if has_q:
         query += """
             AND (
                 t.description ILIKE :search_query
@@ -64,102 +167,100 @@ def search_transactions(
                 OR at.name ILIKE :search_query
             )
         """
-        params["search_query"] = f"%{q}%"
 
     # Фильтры по датам
-    if start_date:
+    if has_start:
         query += " AND t.date >= :start_date"
-        params["start_date"] = start_date
-
-    if end_date:
+    if has_end:
         query += " AND t.date <= :end_date"
-        params["end_date"] = end_date
 
     # Фильтры по суммам
-    if min_amount is not None:
+    if has_min:
         query += " AND t.amount >= :min_amount"
-        params["min_amount"] = min_amount
-
-    if max_amount is not None:
+    if has_max:
         query += " AND t.amount <= :max_amount"
-        params["max_amount"] = max_amount
-
-    # Фильтры по счетам
-    if account_ids:
-        query += " AND (t.account_from_id = ANY(:account_ids) OR t.account_to_id = ANY(:account_ids))"
-        params["account_ids"] = account_ids
-
-    # Фильтры по категориям
-    if category_ids:
-        query += " AND (t.category_id = ANY(:category_ids) OR t.subcategory_id = ANY(:category_ids))"
-        params["category_ids"] = category_ids
 
     # Фильтры по типам
-    if transaction_types:
-        # Convert list of Enums to list of strings
-        transaction_type_values = [ttype.value for ttype in transaction_types]
+    if has_types:
         query += " AND t.type = ANY(:transaction_types)"
-        params["transaction_types"] = transaction_type_values
 
     # Фильтры по тегам
-    if tag_ids:
+    if has_tags:
         query += " AND EXISTS (SELECT 1 FROM transaction_tags tt2 WHERE tt2.transaction_id = t.id AND tt2.tag_id = ANY(:tag_ids))"
-        params["tag_ids"] = tag_ids
 
-    query += """
-        GROUP BY t.id, c.name, c.icon, c.color, sc.name, af.name, at.name
+    return with_sql, query
+
+
+@lru_cache(maxsize=512)
+def _build_search_sql(*filters: bool) -> TextClause:
+    """Текст запроса зависит только от набора заданных фильтров, поэтому кэшируется по нему"""
+    with_sql, query = _search_sql_parts(*filters)
+    return text(with_sql + SEARCH_SELECT_SQL + query + """
         ORDER BY t.date DESC, t.time DESC
         LIMIT :limit OFFSET :offset
-    """
+    """)
 
-    result = db.execute(text(query), params)
 
-    # Получаем общее количество
-    # To get total count, remove LIMIT, OFFSET, and GROUP BY from the main query.
-    # A more robust way would be to create a separate count query or use SQLAlchemy ORM's count.
-    count_query_base = """
-        SELECT COUNT(DISTINCT t.id)
-        FROM transactions t
-        LEFT JOIN categories c ON t.category_id = c.id
-        LEFT JOIN accounts af ON t.account_from_id = af.id
-        LEFT JOIN accounts at ON t.account_to_id = at.id
-        LEFT JOIN transaction_tags tt ON t.id = tt.transaction_id
-        LEFT JOIN tags tg ON tt.tag_id = tg.id
-        WHERE 1=1
-    """
-    # Re-apply filters for the count query
-    count_query = count_query_base
-    count_params = {k: v for k, v in params.items() if k not in ['limit', 'offset']}
-    if q:
-        count_query += """
-            AND (
-                t.description ILIKE :search_query
-                OR t.notes ILIKE :search_query
-                OR c.name ILIKE :search_query
-                OR af.name ILIKE :search_query
-                OR at.name ILIKE :search_query
-            )
-        """
-    if start_date:
-        count_query += " AND t.date >= :start_date"
-    if end_date:
-        count_query += " AND t.date <= :end_date"
-    if min_amount is not None:
-        count_query += " AND t.amount >= :min_amount"
-    if max_amount is not None:
-        count_query += " AND t.amount <= :max_amount"
-    if account_ids:
-        count_query += " AND (t.account_from_id = ANY(:account_ids) OR t.account_to_id = ANY(:account_ids))"
-    if category_ids:
-        count_query += " AND (t.category_id = ANY(:category_ids) OR t.subcategory_id = ANY(:category_ids))"
-    if transaction_types:
-        count_query += " AND t.type = ANY(:transaction_types)"
-    if tag_ids:
-        count_query += " AND EXISTS (SELECT 1 FROM transaction_tags tt2 WHERE tt2.transaction_id = t.id AND tt2.tag_id = ANY(:tag_ids))"
-
-    total_count = db.execute(text(count_query), count_params).scalar()
-
-    transactions = [dict(row._asdict()) for row in result]
+@lru_cache(maxsize=512)
+def _build_search_count_sql(*filters: bool) -> TextClause:
+    with_sql, query = _search_sql_parts(*filters)
+    return text(with_sql + " SELECT COUNT(*) FROM transactions t" + query)
+
+
+@router.get("/search/transactions")
+async def search_transactions(
+        q: Optional[str] = Query(None, description="Поисковый запрос"),
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        min_amount: Optional[Decimal] = None,
+        max_amount: Optional[Decimal] = None,
+        account_ids: Optional[List[int]] = Query(None),
+        category_ids: Optional[List[int]] = Query(None),
+        tag_ids: Optional[List[int]] = Query(None),
+        transaction_types: Optional[List[TransactionType]] = Query(None),
+        limit: int = Query(default=50, le=500),
+        offset: int = 0,
+        db: AsyncSession = Depends(get_async_db)
+):
+    filters = (
+        bool(q), start_date is not None, end_date is not None,
+        min_amount is not None, max_amount is not None,
+        bool(account_ids), bool(category_ids), bool(transaction_types), bool(tag_ids)
+    )
+    params = {
+        "limit": limit,
+        "offset": offset,
+        "search_query": f"%{q}%" if q else None,
+        "start_date": start_date,
+        "end_date": end_date,
+        "min_amount": min_amount,
+        "max_amount": max_amount,
+        "account_ids": account_ids,
+        "category_ids": category_ids,
+        # Convert list of Enums to list of strings
+        "transaction_types": [ttype.value for ttype in transaction_types] if transaction_types else None,
+        "tag_ids": tag_ids
+    }
+
+    result = await db.execute(_build_search_sql(*filters), params)
+
+    transactions = [dict(row) for row in result.mappings()]
+
+    # Общее количество приходит в каждой строке через COUNT(*) OVER ().
+    # Страница за концом результатов пуста, тогда total считается отдельным запросом
+    if transactions:
+        total_count = transactions[0]["total_count"]
+    elif offset > 0:
+        total_count = (await db.execute(_build_search_count_sql(*filters), params)).scalar()
+    else:
+        total_count = 0
+    for t in transactions:
+        del t["total_count"]
+
+    # Теги подгружаются вторым запросом только для текущей страницы
+    tags_map = await fetch_tags_by_transaction(db, [t["id"] for t in transactions])
+    for t in transactions:
+        t["tags"] = tags_map.get(t["id"])
 
     return {
         "transactions": transactions,
@@ -169,18 +270,64 @@ def search_transactions(
     }
 
 
-@router.get("/export/{format}")
-def export_data(
-        format: str,
-        start_date: Optional[date] = None,
-        end_date: Optional[date] = None,
-        db: Session = Depends(get_db)
-):
-    if format not in ["csv", "json"]:
-        raise HTTPException(status_code=400, detail="Формат должен быть csv или json")
+EXPORT_BATCH_SIZE = 1000
+EXPORT_SQL = """
+    SELECT
+        t.id,
+        t.date,
+        t.type,
+        t.amount,
+        t.description,
+        t.notes,
+        c.name as category,
+        af.name as account_from,
+        at.name as account_to
+    FROM transactions t
+    LEFT JOIN categories c ON t.category_id = c.id
+    LEFT JOIN accounts af ON t.account_from_id = af.id
+    LEFT JOIN accounts at ON t.account_to_id = at.id
+    WHERE 1=1
+"""
+
+
+@lru_cache(maxsize=4)
+def _export_query(has_start: bool, has_end: bool) -> TextClause:
+    query = EXPORT_SQL
+    if has_start:
+        query += " AND t.date >= :start_date"
+    if has_end:
+        query += " AND t.date <= :end_date"
+    query += " ORDER BY t.date DESC"
+    return text(query)
+
 
-    # Получаем транзакции
-    query = """
+async def iter_export_batches(query: TextClause, params: Dict[str, Any]):
+    """
+    Читает транзакции для экспорта партиями через серверный курсор.
+    Сессия своя: генератор живет дольше, чем зависимость get_async_db запроса.
+    """
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(query, params)
+        async for partition in result.mappings().partitions(EXPORT_BATCH_SIZE):
+            rows = [dict(row) for row in partition]
+            # id нужен только для подгрузки тегов, в экспорт он не попадает
+            tags_map = await fetch_tags_by_transaction(db, [r["id"] for r in rows])
+            for r in rows:
+                r["tags"] = tags_map.get(r.pop("id"))
+            yield rows
+
+
+@lru_cache(maxsize=4)
+def _export_csv_copy_sql(has_start: bool, has_end: bool) -> str:
+    """COPY для CSV-экспорта: строки и теги форматирует сам PostgreSQL"""
+    conditions = []
+    if has_start:
+        conditions.append(f"t.date >= ${len(conditions) + 1}")
+    if has_end:
+        conditions.append(f"t.date <= ${len(conditions) + 1}")
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+
+    return f"""
         SELECT
             t.date,
             t.type,
@@ -190,212 +337,297 @@ def export_data(
             c.name as category,
             af.name as account_from,
             at.name as account_to,
-            array_agg(DISTINCT tg.name) FILTER (WHERE tg.name IS NOT NULL) as tags
+            (
+                SELECT string_agg(tg.name, ', ' ORDER BY tg.name)
+                FROM transaction_tags tt
+                JOIN tags tg ON tt.tag_id = tg.id
+                WHERE tt.transaction_id = t.id
+            ) as tags
         FROM transactions t
         LEFT JOIN categories c ON t.category_id = c.id
         LEFT JOIN accounts af ON t.account_from_id = af.id
         LEFT JOIN accounts at ON t.account_to_id = at.id
-        LEFT JOIN transaction_tags tt ON t.id = tt.transaction_id
-        LEFT JOIN tags tg ON tt.tag_id = tg.id
-        WHERE 1=1
+        {where}
+        ORDER BY t.date DESC
     """
-    params = {}
 
-    if start_date:
-        query += " AND t.date >= :start_date"
-        params["start_date"] = start_date
 
-    if end_date:
-        query += " AND t.date <= :end_date"
-        params["end_date"] = end_date
+async def iter_csv_copy(query: str, args: List[Any]):
+    """
+    Стримит результат COPY (...) TO STDOUT. asyncpg отдает данные в колбэк,
+    поэтому чанки передаются в генератор через очередь с ограниченным размером.
+    """
+    queue = asyncio.Queue(maxsize=16)
+
+    async def run_copy():
+        try:
+            async with AsyncSessionLocal() as db:
+                conn = await db.connection()
+                raw = await conn.get_raw_connection()
+                await raw.driver_connection.copy_from_query(
+                    query, *args, output=queue.put, format='csv', header=True
+                )
+        finally:
+            await queue.put(None)
+
+    task = asyncio.create_task(run_copy())
+    try:
+        yield '\ufeff'  # BOM, чтобы Excel открывал UTF-8 корректно
+        while (chunk := await queue.get()) is not None:
+            yield chunk
+        await task  # пробрасывает ошибку COPY, если она была
+    finally:
+        task.cancel()
+
+
+async def iter_json(batches):
+    yield b'['
+    first = True
+    async for rows in batches:
+        # orjson не сериализует Decimal, суммы отдаются строкой, как и раньше
+        chunk = b','.join(orjson.dumps(t, default=str) for t in rows)
+        if chunk:
+            yield chunk if first else b',' + chunk
+            first = False
+    yield b']'
 
-    query += " GROUP BY t.id, t.date, t.type, t.amount, t.description, t.notes, c.name, af.name, at.name"
-    query += " ORDER BY t.date DESC"
 
-    result = db.execute(text(query), params)
-    transactions = [dict(row._asdict()) for row in result]
+@router.get("/export/{format}")
+async def export_data(
+        format: str,
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None
+):
+    if format not in ["csv", "json"]:
+        raise HTTPException(status_code=400, detail="Формат должен быть csv или json")
 
     if format == "csv":
-        output = io.StringIO()
-        fieldnames = [
-            "date", "type", "amount", "description", "notes",
-            "category", "account_from", "account_to", "tags"
-        ]
-        writer = csv.DictWriter(output, fieldnames=fieldnames, extrasaction='ignore')
-        writer.writeheader()
-
-        for t in transactions:
-            t['tags'] = ', '.join(t['tags']) if t['tags'] else ''
-            writer.writerow(t)
-
-        output.seek(0)
+        query = _export_csv_copy_sql(start_date is not None, end_date is not None)
+        args = [d for d in (start_date, end_date) if d is not None]
         return StreamingResponse(
-            io.BytesIO(output.getvalue().encode('utf-8-sig')),
+            iter_csv_copy(query, args),
             media_type="text/csv",
             headers={
                 "Content-Disposition": f"attachment; filename=transactions_{datetime.now().strftime('%Y%m%d')}.csv"}
         )
 
     else:  # json
+        # Получаем транзакции
+        query = _export_query(start_date is not None, end_date is not None)
+        params = {"start_date": start_date, "end_date": end_date}
         return StreamingResponse(
-            io.BytesIO(json.dumps(transactions, default=str, ensure_ascii=False).encode('utf-8')),
+            iter_json(iter_export_batches(query, params)),
             media_type="application/json",
             headers={
                 "Content-Disposition": f"attachment; filename=transactions_{datetime.now().strftime('%Y%m%d')}.json"}
         )
 
 
+def parse_import_csv(content: bytes) -> List[Dict[str, Any]]:
+    """
+    С pyarrow CSV разбирается и типизируется в C: даты и суммы приходят готовыми объектами.
+    Без pyarrow или при невалидных значениях в файле - построчный разбор через csv,
+    чтобы ошибки попали в отчет по конкретным строкам.
+    """
+    if pa is not None:
+        column_types = {
+            "date": pa.date32(),
+            "amount": pa.decimal128(18, 2),
+            "type": pa.string(),
+            "description": pa.string(),
+            "notes": pa.string(),
+            "category": pa.string(),
+            "account_from": pa.string(),
+            "account_to": pa.string(),
+            "tags": pa.string()
+        }
+        try:
+            table = pa_csv.read_csv(
+                io.BytesIO(content),
+                convert_options=pa_csv.ConvertOptions(column_types=column_types)
+            )
+            return table.to_pylist()
+        except pa.ArrowException:
+            pass
+
+    text_content = content.decode('utf-8-sig')
+    return list(csv.DictReader(io.StringIO(text_content)))
+
+
 @router.post("/import")
 async def import_data(
         file: UploadFile = File(...),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_async_db)
 ):
     if not file.filename.endswith(('.csv', '.json')):
         raise HTTPException(status_code=400, detail="Файл должен быть в формате CSV или JSON")
 
     content = await file.read()
-    trans = db.begin()  # Start transaction for import
 
     try:
-        if file.filename.endswith('.csv'):
-            # Парсим CSV
-            text_content = content.decode('utf-8-sig')
-            reader = csv.DictReader(io.StringIO(text_content))
-            transactions_data = list(reader)
-        else:
-            # Парсим JSON
-            transactions_data = json.loads(content)
-
-        imported_count = 0
-        errors = []
-
-        for idx, t in enumerate(transactions_data):
-            try:
-                # Basic validation and type conversion
-                transaction_date = date.fromisoformat(t['date'])
-                transaction_type = TransactionType(t['type'])  # Ensures enum is valid
-                amount = Decimal(t['amount'])
-                if amount <= 0:
-                    raise ValueError("Amount must be positive.")
-
-                # Находим или создаем категорию
-                category_id = None
-                if t.get('category'):
-                    cat_result = db.execute(
-                        text("SELECT id FROM categories WHERE name = :name LIMIT 1"),
-                        {"name": t['category']}
-                    ).fetchone()
-
-                    if cat_result:
-                        category_id = cat_result[0]
-                    else:
-                        # Создаем новую категорию
-                        new_cat = db.execute(
-                            text("""
-                                INSERT INTO categories (name, type, icon, color)
-                                VALUES (:name, :type, '📁', '#5e72e4')
-                                RETURNING id
-                            """),
-                            {"name": t['category'], "type": transaction_type.value}  # Use .value for enum
-                        ).fetchone()
-                        category_id = new_cat[0]
-
-                # Находим счета
-                account_from_id = None
-                account_to_id = None
-
-                if t.get('account_from'):
-                    acc_result = db.execute(
-                        text("SELECT id FROM accounts WHERE name = :name LIMIT 1"),
-                        {"name": t['account_from']}
-                    ).fetchone()
-                    if acc_result:
-                        account_from_id = acc_result[0]
-                    else:
-                        errors.append(f"Строка {idx + 1}: Счет 'account_from' '{t['account_from']}' не найден.")
-                        continue  # Skip this transaction
-
-                if t.get('account_to'):
-                    acc_result = db.execute(
-                        text("SELECT id FROM accounts WHERE name = :name LIMIT 1"),
-                        {"name": t['account_to']}
-                    ).fetchone()
-                    if acc_result:
-                        account_to_id = acc_result[0]
-                    else:
-                        errors.append(f"Строка {idx + 1}: Счет 'account_to' '{t['account_to']}' не найден.")
-                        continue  # Skip this transaction
-
-                # Validate account presence based on transaction type
-                if transaction_type == TransactionType.expense and not account_from_id:
-                    raise ValueError("Для расхода требуется 'account_from'.")
-                if transaction_type == TransactionType.income and not account_to_id:
-                    raise ValueError("Для дохода требуется 'account_to'.")
-                if transaction_type == TransactionType.transfer and (not account_from_id or not account_to_id):
-                    raise ValueError("Для перевода требуются 'account_from' и 'account_to'.")
-
-                # Создаем транзакцию
-                insert_result = db.execute(text("""
-                    INSERT INTO transactions (
-                        date, type, amount, account_from_id, account_to_id,
-                        category_id, description, notes
-                    ) VALUES (
-                        :date, :type, :amount, :account_from_id, :account_to_id,
-                        :category_id, :description, :notes
-                    ) RETURNING id
-                """), {
-                    "date": transaction_date,
-                    "type": transaction_type.value,
-                    "amount": amount,
-                    "account_from_id": account_from_id,
-                    "account_to_id": account_to_id,
-                    "category_id": category_id,
-                    "description": t.get('description'),
-                    "notes": t.get('notes')
+        async with db.begin():  # Start transaction for import
+            if file.filename.endswith('.csv'):
+                # Парсим CSV
+                transactions_data = parse_import_csv(content)
+            else:
+                # Парсим JSON
+                transactions_data = json.loads(content)
+
+            errors = []
+
+            # Справочники загружаются один раз вместо SELECT на каждую строку
+            cat_map = {row.name: row.id for row in await db.execute(CATEGORY_IDS_QUERY)}
+            acc_map = {row.name: row.id for row in await db.execute(ACCOUNT_IDS_QUERY)}
+            tag_map = {row.name: row.id for row in await db.execute(TAG_IDS_QUERY)}
+
+            # Первый проход: валидация и подготовка строк без обращений к БД.
+            # Недостающие категории и теги только собираются и создаются пачкой после прохода
+            new_categories = {}
+            new_tags = {}  # lower(name) -> имя в написании из файла
+            rows = []
+            rows_category = []
+            rows_tag_names = []
+
+            for idx, t in enumerate(transactions_data):
+                try:
+                    # Basic validation and type conversion
+                    # Из pyarrow дата приходит уже объектом date
+                    transaction_date = t['date'] if isinstance(t['date'], date) else date.fromisoformat(t['date'])
+                    transaction_type = TransactionType(t['type'])  # Ensures enum is valid
+                    amount = Decimal(t['amount'])
+                    if amount <= 0:
+                        raise ValueError("Amount must be positive.")
+
+                    category = t.get('category') or None
+                    if category is not None and not isinstance(category, str):
+                        raise ValueError("'category' должна быть строкой.")
+
+                    tags = t.get('tags') or None
+                    if tags is not None and not isinstance(tags, str):
+                        raise ValueError("'tags' должны быть строкой с именами через запятую.")
+                    tag_names = {}
+                    if tags:
+                        for tag_name in (tag.strip() for tag in tags.split(',')):
+                            if tag_name:
+                                tag_names.setdefault(tag_name.lower(), tag_name)
+
+                    # Находим счета
+                    account_from_id = None
+                    account_to_id = None
+
+                    if t.get('account_from'):
+                        account_from_id = acc_map.get(t['account_from'])
+                        if not account_from_id:
+                            errors.append(f"Строка {idx + 1}: Счет 'account_from' '{t['account_from']}' не найден.")
+                            continue  # Skip this transaction
+
+                    if t.get('account_to'):
+                        account_to_id = acc_map.get(t['account_to'])
+                        if not account_to_id:
+                            errors.append(f"Строка {idx + 1}: Счет 'account_to' '{t['account_to']}' не найден.")
+                            continue  # Skip this transaction
+
+                    # Validate account presence based on transaction type
+                    if transaction_type == TransactionType.expense and not account_from_id:
+                        raise ValueError("Для расхода требуется 'account_from'.")
+                    if transaction_type == TransactionType.income and not account_to_id:
+                        raise ValueError("Для дохода требуется 'account_to'.")
+                    if transaction_type == TransactionType.transfer and (not account_from_id or not account_to_id):
+                        raise ValueError("Для перевода требуются 'account_from' и 'account_to'.")
+
+                    rows.append({
+                        "date": transaction_date,
+                        "type": transaction_type.value,
+                        "amount": amount,
+                        "account_from_id": account_from_id,
+                        "account_to_id": account_to_id,
+                        "category_id": None,  # Заполняется после создания недостающих категорий
+                        "description": t.get('description'),
+                        "notes": t.get('notes')
+                    })
+                    rows_category.append(category)
+                    rows_tag_names.append(tag_names.keys())
+
+                    if category and category not in cat_map:
+                        new_categories.setdefault(category, transaction_type.value)
+                    for key, tag_name in tag_names.items():
+                        if key not in tag_map:
+                            new_tags.setdefault(key, tag_name)
+
+                except Exception as e:
+                    errors.append(f"Строка {idx + 1} (данные: {t}): {str(e)}")
+
+            if new_categories:
+                created = await db.execute(INSERT_CATEGORIES_QUERY, {
+                    "names": list(new_categories),
+                    "types": list(new_categories.values())
                 })
-                new_transaction_id = insert_result.fetchone()[0]
-
-                # Handle tags for imported transaction
-                if t.get('tags'):
-                    tag_names = [tag.strip() for tag in t['tags'].split(',')]
-                    for tag_name in tag_names:
-                        tag_id = db.execute(
-                            text("SELECT id FROM tags WHERE name = :name LIMIT 1"),
-                            {"name": tag_name}
-                        ).scalar()
-                        if not tag_id:
-                            # Create new tag if it doesn't exist
-                            new_tag = db.execute(
-                                text("INSERT INTO tags (name) VALUES (:name) RETURNING id"),
-                                {"name": tag_name}
-                            ).fetchone()
-                            tag_id = new_tag[0]
-                        db.execute(
-                            text(
-                                "INSERT INTO transaction_tags (transaction_id, tag_id) VALUES (:transaction_id, :tag_id) ON CONFLICT DO NOTHING"),
-                            {"transaction_id": new_transaction_id, "tag_id": tag_id}
-                        )
-
-                # Update account balances
-                if account_from_id:
-                    db.execute(
-                        text(
-                            "UPDATE accounts SET current_balance = current_balance - :amount, updated_at = CURRENT_TIMESTAMP WHERE id = :id"),
-                        {"amount": amount, "id": account_from_id}
-                    )
-                if account_to_id:
-                    db.execute(
-                        text(
-                            "UPDATE accounts SET current_balance = current_balance + :amount, updated_at = CURRENT_TIMESTAMP WHERE id = :id"),
-                        {"amount": amount, "id": account_to_id}
-                    )
-
-                imported_count += 1
-
-            except Exception as e:
-                errors.append(f"Строка {idx + 1} (данные: {t}): {str(e)}")
-
-        trans.commit()  # Commit all changes if no unhandled exceptions
+                cat_map.update({row.name: row.id for row in created})
+
+            if new_tags:
+                created = await db.execute(INSERT_TAGS_QUERY, {"names": list(new_tags.values())})
+                tag_map.update({row.name: row.id for row in created})
+                # Теги, созданные параллельно (ON CONFLICT без RETURNING), дочитываются
+                missing = [name for name in new_tags if name not in tag_map]
+                if missing:
+                    existing = await db.execute(TAG_IDS_BY_NAME_QUERY, {"names": missing})
+                    tag_map.update({row.name: row.id for row in existing})
+
+            for r, category in zip(rows, rows_category):
+                r["category_id"] = cat_map.get(category) if category else None
+            rows_tag_ids = [
+                {tag_map[tag_name] for tag_name in tag_names if tag_name in tag_map}
+                for tag_names in rows_tag_names
+            ]
+
+            # Второй проход: все транзакции одним INSERT с заранее выделенными id
+            if rows:
+                allocated = await db.execute(ALLOCATE_TRANSACTION_IDS_QUERY, {"count": len(rows)})
+                new_ids = [row.id for row in allocated]
+                await db.execute(INSERT_TRANSACTIONS_QUERY, {
+                    "ids": new_ids,
+                    "dates": [r["date"] for r in rows],
+                    "types": [r["type"] for r in rows],
+                    "amounts": [r["amount"] for r in rows],
+                    "account_from_ids": [r["account_from_id"] for r in rows],
+                    "account_to_ids": [r["account_to_id"] for r in rows],
+                    "category_ids": [r["category_id"] for r in rows],
+                    "descriptions": [r["description"] for r in rows],
+                    "notes": [r["notes"] for r in rows]
+                })
+
+                tx_ids = []
+                tag_ids = []
+                for transaction_id, row_tag_ids in zip(new_ids, rows_tag_ids):
+                    for tag_id in row_tag_ids:
+                        tx_ids.append(transaction_id)
+                        tag_ids.append(tag_id)
+
+                if tx_ids:
+                    await db.execute(INSERT_TRANSACTION_TAGS_QUERY, {"tx_ids": tx_ids, "tag_ids": tag_ids})
+
+                # Update account balances: одна агрегированная дельта на счет
+                balance_deltas = {}
+                for r in rows:
+                    if r["account_from_id"]:
+                        balance_deltas[r["account_from_id"]] = balance_deltas.get(r["account_from_id"], 0) - r["amount"]
+                    if r["account_to_id"]:
+                        balance_deltas[r["account_to_id"]] = balance_deltas.get(r["account_to_id"], 0) + r["amount"]
+
+                if balance_deltas:
+                    await db.execute(UPDATE_BALANCES_QUERY, {
+                        "ids": list(balance_deltas),
+                        "deltas": list(balance_deltas.values())
+                    })
+
+            imported_count = len(rows)
+
+        # Импорт мог создать новые категории
+        if new_categories:
+            categories_cache.clear()
+        if imported_count:
+            search_count_cache.clear()
+
         return {
             "imported": imported_count,
             "total": len(transactions_data),
@@ -403,8 +635,6 @@ async def import_data(
         }
 
     except json.JSONDecodeError:
-        trans.rollback()
         raise HTTPException(status_code=400, detail="Неверный формат JSON файла.")
     except Exception as e:
-        trans.rollback()
         raise HTTPException(status_code=400, detail=f"Ошибка при импорте: {str(e)}")
@@ -1,12 +1,16 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
-from typing import List, Dict, Any, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from fastapi.responses import ORJSONResponse
+from typing import List, Dict, Any, Optional, Tuple
 from sqlalchemy.orm import Session
 from sqlalchemy import text
 from dependencies import get_db
+from utils.sql import build_update_query
 from models.schemas import RecurringTransaction, RecurringTransactionCreate, RecurringTransactionUpdate
 from utils.enums import TransactionType
+from routers.transactions import search_count_cache
 from datetime import date, datetime, timedelta
-from dateutil.relativedelta import relativedelta
+import bisect
+import calendar
 
 router = APIRouter(
     prefix="/recurring-transactions",
@@ -14,48 +18,21 @@ router = APIRouter(
 )
 
 
-# Функция для добавления столбца last_created_date если его нет
-def ensure_last_created_date_column(db: Session):
-    """Проверяет и добавляет столбец last_created_date если его нет"""
-    try:
-        # Проверяем, существует ли столбец
-        check_column = """
-            SELECT column_name 
-            FROM information_schema.columns 
-            WHERE table_name = 'recurring_transactions' 
-            AND column_name = 'last_created_date'
-            AND table_schema = 'finance';
-        """
-        result = db.execute(text(check_column)).fetchone()
-
-        if not result:
-            # Добавляем столбец если его нет
-            add_column = """
-                ALTER TABLE recurring_transactions 
-                ADD COLUMN last_created_date DATE;
-            """
-            db.execute(text(add_column))
-            db.commit()
-            print("Added last_created_date column to recurring_transactions table")
-    except Exception as e:
-        print(f"Column might already exist or error: {e}")
-        db.rollback()
-
-
-@router.get("/", response_model=List[Dict[str, Any]])
+# Ответ - готовый JSON из json_agg, поэтому без response_model: схема не проверяется
+@router.get("/", response_class=ORJSONResponse)
 def get_recurring_transactions(
         active_only: bool = True,
+        limit: Optional[int] = Query(default=None, le=1000),  # По умолчанию весь список (LIMIT NULL)
+        offset: int = 0,
         db: Session = Depends(get_db)
 ):
-    # Убеждаемся что столбец существует
-    ensure_last_created_date_column(db)
-
+    # Только поля, которые использует список на фронтенде
     query = """
         SELECT
-            rt.*,
+            rt.id, rt.name, rt.type, rt.amount, rt.frequency,
+            rt.start_date, rt.end_date, rt.last_created_date, rt.is_active,
+            rt.category_id, rt.account_from_id, rt.account_to_id,
             c.name as category_name,
-            c.icon as category_icon,
-            c.color as category_color,
             af.name as account_from_name,
             at.name as account_to_name
         FROM recurring_transactions rt
@@ -68,10 +45,14 @@ def get_recurring_transactions(
     if active_only:
         query += " AND rt.is_active = true"
 
-    query += " ORDER BY rt.created_at DESC"
+    query += " ORDER BY rt.created_at DESC LIMIT :limit OFFSET :offset"
 
-    result = db.execute(text(query))
-    return [dict(row._asdict()) for row in result]
+    # JSON собирается в Postgres, Python только передает готовую строку
+    payload = db.execute(
+        text(f"SELECT COALESCE(json_agg(t), '[]'::json)::text FROM ({query}) t"),
+        {"limit": limit, "offset": offset}
+    ).scalar()
+    return Response(content=payload, media_type="application/json")
 
 
 @router.post("/", response_model=RecurringTransaction)
@@ -79,8 +60,6 @@ def create_recurring_transaction(
         transaction: RecurringTransactionCreate,
         db: Session = Depends(get_db)
 ):
-    ensure_last_created_date_column(db)
-
     query = """
         INSERT INTO recurring_transactions (
             name, type, amount, account_from_id, account_to_id,
@@ -99,21 +78,148 @@ def create_recurring_transaction(
     return dict(result.fetchone()._asdict())
 
 
+def _add_months(d: date, months: int) -> date:
+    """Сдвиг на N месяцев; день округляется вниз до конца месяца, как в relativedelta"""
+    year, month = divmod(d.month - 1 + months, 12)
+    year += d.year
+    day = min(d.day, calendar.monthrange(year, month + 1)[1])
+    return date(year, month + 1, day)
+
+
+# Шаг частоты в днях или в месяцах
+DAY_STEPS = {'daily': 1, 'weekly': 7}
+MONTH_STEPS = {'monthly': 1, 'quarterly': 3, 'yearly': 12}
+
+
+def generate_dates(
+        last_date: date,
+        frequency: str,
+        until: date,
+        end_date: Optional[date] = None,
+        limit: int = 100
+) -> List[date]:
+    """
+    Даты после last_date с шагом frequency, не позже until и end_date.
+    Количество шагов вычисляется сразу, без проверки частоты на каждой итерации
+    """
+    if end_date and end_date < until:
+        until = end_date
+    if until <= last_date:
+        return []
+
+    if frequency in DAY_STEPS:
+        step = DAY_STEPS[frequency]
+        n = min((until - last_date).days // step, limit)
+        dates = [last_date + timedelta(days=step * i) for i in range(1, n + 1)]
+    elif frequency in MONTH_STEPS:
+        step = MONTH_STEPS[frequency]
+        months = (until.year - last_date.year) * 12 + (until.month - last_date.month)
+        n = min(months // step, limit)
+        dates = [_add_months(last_date, step * i) for i in range(1, n + 1)]
+    else:
+        raise ValueError(f"Неизвестная частота: {frequency}")
+
+    # Последняя дата может выйти за until из-за дня месяца
+    return dates[:bisect.bisect_right(dates, until)]
+
+
+def calculate_due_dates(rt, current_date: date) -> List[date]:
+    """Даты, на которые нужно создать транзакции, начиная с последней обработанной"""
+    return generate_dates(
+        rt.last_created_date or rt.start_date, rt.frequency, current_date, rt.end_date
+    )
+
+
+# Запросы обработки строятся один раз на модуль: один и тот же объект text()
+# переиспользует скомпилированную форму из кэша SQLAlchemy при каждом вызове
+INSERT_RECURRING_BATCH_QUERY = text("""
+    INSERT INTO transactions (
+        date, type, amount, account_from_id, account_to_id,
+        category_id, description, is_planned, is_recurring, recurring_id
+    )
+    SELECT
+        d.date, rt.type, rt.amount, rt.account_from_id, rt.account_to_id,
+        rt.category_id, rt.name || ' (автоматически)', false, true, rt.id
+    FROM unnest(CAST(:ids AS int[]), CAST(:dates AS date[])) AS d(recurring_id, date)
+    JOIN recurring_transactions rt ON rt.id = d.recurring_id
+""")
+
+UPDATE_BALANCES_QUERY = text("""
+    UPDATE accounts a
+    SET current_balance = a.current_balance + d.delta
+    FROM unnest(CAST(:ids AS int[]), CAST(:deltas AS numeric[])) AS d(id, delta)
+    WHERE a.id = d.id
+""")
+
+UPDATE_LAST_CREATED_QUERY = text("""
+    UPDATE recurring_transactions rt
+    SET last_created_date = v.last_date
+    FROM unnest(CAST(:ids AS int[]), CAST(:dates AS date[])) AS v(id, last_date)
+    WHERE rt.id = v.id
+""")
+
+SELECT_FOR_PROCESS_QUERY = text(
+    "SELECT * FROM recurring_transactions WHERE id = :id AND is_active = true FOR NO KEY UPDATE"
+)
+
+
+def create_recurring_batch(db: Session, batch: List[Tuple[Any, List[date]]]):
+    """
+    Создает транзакции для набора (повторяющаяся транзакция, даты):
+    один INSERT, один UPDATE на балансы и один на last_created_date
+    """
+    batch = [(rt, due_dates) for rt, due_dates in batch if due_dates]
+    if not batch:
+        return
+
+    # Все транзакции одним INSERT; поля и описание берутся из самой повторяющейся транзакции
+    db.execute(INSERT_RECURRING_BATCH_QUERY, {
+        "ids": [rt.id for rt, due_dates in batch for _ in due_dates],
+        "dates": [due_date for _, due_dates in batch for due_date in due_dates]
+    })
+
+    # Обновляем балансы счетов: одна суммарная дельта на счет
+    balance_deltas = {}
+    for rt, due_dates in batch:
+        total_amount = rt.amount * len(due_dates)
+        if rt.account_from_id:
+            balance_deltas[rt.account_from_id] = balance_deltas.get(rt.account_from_id, 0) - total_amount
+        if rt.account_to_id:
+            balance_deltas[rt.account_to_id] = balance_deltas.get(rt.account_to_id, 0) + total_amount
+
+    if balance_deltas:
+        db.execute(UPDATE_BALANCES_QUERY, {"ids": list(balance_deltas), "deltas": list(balance_deltas.values())})
+
+    # Обновляем last_created_date только у тех, для кого создали транзакции
+    db.execute(UPDATE_LAST_CREATED_QUERY, {"ids": [rt.id for rt, _ in batch], "dates": [due_dates[-1] for _, due_dates in batch]})
+
+
+# NULL - не найдена или неактивна, false - все уже создано
+PROCESS_PRECHECK_QUERY = text("""
+    SELECT COALESCE(last_created_date, start_date) < CURRENT_DATE
+    FROM recurring_transactions
+    WHERE id = :id AND is_active = true
+""")
+
+
 @router.post("/{id}/process")
 def process_recurring_transaction(
         id: int,
         db: Session = Depends(get_db)
 ):
     """Создает транзакции для повторяющейся транзакции с улучшенной логикой"""
-    ensure_last_created_date_column(db)
+    # Дешевая проверка без блокировки: частый вызов "нечего создавать" не берет row lock
+    is_due = db.execute(PROCESS_PRECHECK_QUERY, {"id": id}).scalar()
+
+    if is_due is None:
+        raise HTTPException(status_code=404, detail="Повторяющаяся транзакция не найдена или неактивна")
+
+    if not is_due:
+        return {"created": 0, "message": "Все транзакции уже созданы на сегодня"}
 
-    trans = db.begin()
     try:
         # Получаем повторяющуюся транзакцию
-        rt = db.execute(
-            text("SELECT * FROM recurring_transactions WHERE id = :id AND is_active = true FOR UPDATE"),
-            {"id": id}
-        ).fetchone()
+        rt = db.execute(SELECT_FOR_PROCESS_QUERY, {"id": id}).fetchone()
 
         if not rt:
             raise HTTPException(status_code=404, detail="Повторяющаяся транзакция не найдена или неактивна")
@@ -121,126 +227,129 @@ def process_recurring_transaction(
         # Определяем начальную дату для создания транзакций
         last_date = rt.last_created_date or rt.start_date
         current_date = date.today()
-        created_count = 0
 
-        # Если уже все транзакции созданы на сегодня
+        # Другой запрос мог обработать ее между проверкой и блокировкой
         if last_date >= current_date:
-            trans.rollback()
+            db.rollback()
             return {"created": 0, "message": "Все транзакции уже созданы на сегодня"}
 
-        # Начинаем с последней обработанной даты
-        next_date = last_date
-        actual_last_date = last_date
-
-        # Создаем транзакции до текущей даты
-        while created_count < 100:  # Ограничение для предотвращения бесконечного цикла
-            # Вычисляем следующую дату в зависимости от частоты
-            if rt.frequency == 'daily':
-                next_date = next_date + timedelta(days=1)
-            elif rt.frequency == 'weekly':
-                next_date = next_date + timedelta(weeks=1)
-            elif rt.frequency == 'monthly':
-                next_date = next_date + relativedelta(months=1)
-            elif rt.frequency == 'quarterly':
-                next_date = next_date + relativedelta(months=3)
-            elif rt.frequency == 'yearly':
-                next_date = next_date + relativedelta(years=1)
-            else:
-                raise ValueError(f"Неизвестная частота: {rt.frequency}")
-
-            # Проверяем, не превысили ли текущую дату
-            if next_date > current_date:
-                break
-
-            # Проверяем, не превысили ли конечную дату
-            if rt.end_date and next_date > rt.end_date:
-                break
-
-            # Создаем транзакцию
-            transaction_params = {
-                "date": next_date,
-                "type": rt.type,
-                "amount": rt.amount,
-                "account_from_id": rt.account_from_id,
-                "account_to_id": rt.account_to_id,
-                "category_id": rt.category_id,
-                "description": f"{rt.name} (автоматически)",
-                "is_planned": False,
-                "is_recurring": True,
-                "recurring_id": rt.id
-            }
-
-            # Создаем транзакцию
-            db.execute(text("""
-                INSERT INTO transactions (
-                    date, type, amount, account_from_id, account_to_id,
-                    category_id, description, is_planned, is_recurring, recurring_id
-                ) VALUES (
-                    :date, :type, :amount, :account_from_id, :account_to_id,
-                    :category_id, :description, :is_planned, :is_recurring, :recurring_id
-                )
-            """), transaction_params)
-
-            # Обновляем балансы счетов
-            if rt.account_from_id:
-                db.execute(
-                    text("UPDATE accounts SET current_balance = current_balance - :amount WHERE id = :id"),
-                    {"amount": rt.amount, "id": rt.account_from_id}
-                )
-            if rt.account_to_id:
-                db.execute(
-                    text("UPDATE accounts SET current_balance = current_balance + :amount WHERE id = :id"),
-                    {"amount": rt.amount, "id": rt.account_to_id}
-                )
-
-            created_count += 1
-            actual_last_date = next_date
-
-        # Обновляем last_created_date только если создали транзакции
-        if created_count > 0:
-            db.execute(
-                text("UPDATE recurring_transactions SET last_created_date = :date WHERE id = :id"),
-                {"date": actual_last_date, "id": id}
-            )
-
-        trans.commit()
+        due_dates = calculate_due_dates(rt, current_date)
+        create_recurring_batch(db, [(rt, due_dates)])
+
+        created_count = len(due_dates)
+        actual_last_date = due_dates[-1] if due_dates else last_date
+
+        db.commit()
+        if created_count:
+            search_count_cache.clear()
         return {
             "created": created_count,
             "last_processed_date": actual_last_date.isoformat(),
             "message": f"Создано {created_count} транзакций"
         }
 
+    except HTTPException:
+        db.rollback()
+        raise
     except Exception as e:
-        trans.rollback()
+        db.rollback()
         raise HTTPException(status_code=500, detail=f"Ошибка при обработке: {str(e)}")
 
 
+# Все активные повторяющиеся транзакции одним запросом: даты генерируются в Postgres
+# как base + шаг * n (как generate_dates), вставка, балансы и last_created_date в CTE.
+# Строки, заблокированные параллельной обработкой, пропускаются
+PROCESS_ALL_QUERY = text("""
+    WITH active AS (
+        SELECT
+            id, type, amount, account_from_id, account_to_id, category_id, name, frequency,
+            COALESCE(last_created_date, start_date) AS base,
+            LEAST(CURRENT_DATE, COALESCE(end_date, CURRENT_DATE)) AS until
+        FROM recurring_transactions
+        WHERE is_active = true
+          AND COALESCE(last_created_date, start_date) < CURRENT_DATE
+        FOR NO KEY UPDATE SKIP LOCKED
+    ), steps(frequency, step) AS (
+        VALUES
+            ('daily', interval '1 day'),
+            ('weekly', interval '1 week'),
+            ('monthly', interval '1 month'),
+            ('quarterly', interval '3 months'),
+            ('yearly', interval '1 year')
+    ), due AS (
+        SELECT a.*, (a.base + s.step * n)::date AS due_date
+        FROM active a
+        JOIN steps s ON s.frequency = a.frequency
+        CROSS JOIN LATERAL generate_series(1, 100) AS n
+        WHERE (a.base + s.step * n)::date <= a.until
+    ), inserted AS (
+        INSERT INTO transactions (
+            date, type, amount, account_from_id, account_to_id,
+            category_id, description, is_planned, is_recurring, recurring_id
+        )
+        SELECT
+            due_date, type, amount, account_from_id, account_to_id,
+            category_id, name || ' (автоматически)', false, true, id
+        FROM due
+        RETURNING recurring_id, date, amount, account_from_id, account_to_id
+    ), per_rt AS (
+        SELECT recurring_id, COUNT(*) AS created, MAX(date) AS last_date
+        FROM inserted
+        GROUP BY recurring_id
+    ), balances AS (
+        UPDATE accounts a
+        SET current_balance = a.current_balance + d.delta
+        FROM (
+            SELECT account_id, SUM(delta) AS delta
+            FROM (
+                SELECT account_from_id AS account_id, -amount AS delta
+                FROM inserted WHERE account_from_id IS NOT NULL
+                UNION ALL
+                SELECT account_to_id, amount
+                FROM inserted WHERE account_to_id IS NOT NULL
+            ) deltas
+            GROUP BY account_id
+        ) d
+        WHERE a.id = d.account_id
+    ), marked AS (
+        UPDATE recurring_transactions rt
+        SET last_created_date = p.last_date
+        FROM per_rt p
+        WHERE rt.id = p.recurring_id
+    )
+    SELECT
+        a.id,
+        a.frequency,
+        EXISTS (SELECT 1 FROM steps s WHERE s.frequency = a.frequency) AS known_frequency,
+        COALESCE(p.created, 0) AS created
+    FROM active a
+    LEFT JOIN per_rt p ON p.recurring_id = a.id
+    ORDER BY a.id
+""")
+
+
 @router.post("/process-all")
 def process_all_recurring_transactions(db: Session = Depends(get_db)):
-    """Обрабатывает все активные повторяющиеся транзакции"""
-    ensure_last_created_date_column(db)
-
-    # Получаем все активные повторяющиеся транзакции
-    active_recurring = db.execute(
-        text("SELECT id FROM recurring_transactions WHERE is_active = true")
-    ).fetchall()
+    """Обрабатывает все активные повторяющиеся транзакции одним SQL-запросом"""
+    try:
+        rows = db.execute(PROCESS_ALL_QUERY).fetchall()
+        db.commit()
+        if any(row.created for row in rows):
+            search_count_cache.clear()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Ошибка при обработке: {str(e)}")
 
-    total_created = 0
     results = []
-
-    for row in active_recurring:
-        try:
-            # Вызываем обработку для каждой транзакции
-            result = process_recurring_transaction(row.id, db)
-            total_created += result["created"]
-            if result["created"] > 0:
-                results.append(f"ID {row.id}: {result['created']} транзакций")
-        except Exception as e:
-            results.append(f"ID {row.id}: Ошибка - {str(e)}")
+    for row in rows:
+        if not row.known_frequency:
+            results.append(f"ID {row.id}: Ошибка - Неизвестная частота: {row.frequency}")
+        elif row.created:
+            results.append(f"ID {row.id}: {row.created} транзакций")
 
     return {
-        "total_created": total_created,
-        "processed_count": len(active_recurring),
+        "total_created": sum(row.created for row in rows),
+        "processed_count": len(rows),
         "details": results
     }
 
@@ -252,8 +361,6 @@ def preview_recurring_transactions(
         db: Session = Depends(get_db)
 ):
     """Предварительный просмотр будущих транзакций"""
-    ensure_last_created_date_column(db)
-
     rt = db.execute(
         text("SELECT * FROM recurring_transactions WHERE id = :id"),
         {"id": id}
@@ -264,32 +371,19 @@ def preview_recurring_transactions(
 
     # Генерируем предварительный список на N месяцев вперед
     start_date = rt.last_created_date or rt.start_date or date.today()
-    end_preview = date.today() + relativedelta(months=months_ahead)
-
-    preview_dates = []
-    current_date = start_date
-
-    while len(preview_dates) < 50 and current_date <= end_preview:
-        if rt.frequency == 'daily':
-            current_date = current_date + timedelta(days=1)
-        elif rt.frequency == 'weekly':
-            current_date = current_date + timedelta(weeks=1)
-        elif rt.frequency == 'monthly':
-            current_date = current_date + relativedelta(months=1)
-        elif rt.frequency == 'quarterly':
-            current_date = current_date + relativedelta(months=3)
-        elif rt.frequency == 'yearly':
-            current_date = current_date + relativedelta(years=1)
-
-        # Проверяем конечную дату
-        if rt.end_date and current_date > rt.end_date:
-            break
-
-        preview_dates.append({
-            "date": current_date.isoformat(),
-            "amount": float(rt.amount),
-            "description": f"{rt.name} (автоматически)"
-        })
+    end_preview = _add_months(date.today(), months_ahead)
+
+    try:
+        dates = generate_dates(start_date, rt.frequency, end_preview, rt.end_date, limit=50)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    amount = float(rt.amount)
+    description = f"{rt.name} (автоматически)"
+    preview_dates = [
+        {"date": d.isoformat(), "amount": amount, "description": description}
+        for d in dates
+    ]
 
     return {
         "recurring_transaction": {
@@ -331,39 +425,38 @@ def toggle_recurring_transaction(
     }
 
 
-@router.delete("/{id}")
-def delete_recurring_transaction(id: int, db: Session = Depends(get_db)):
-    # Проверяем, есть ли связанные транзакции
-    linked_count = db.execute(
-        text("SELECT COUNT(*) FROM transactions WHERE recurring_id = :id"),
-        {"id": id}
-    ).scalar()
-
-    if linked_count > 0:
-        # Вместо удаления, деактивируем
-        result = db.execute(
-            text("UPDATE recurring_transactions SET is_active = false WHERE id = :id RETURNING name"),
-            {"id": id}
-        ).fetchone()
-
-        if not result:
-            raise HTTPException(status_code=404, detail="Повторяющаяся транзакция не найдена")
+DELETE_OR_DEACTIVATE_QUERY = text("""
+    WITH linked AS (
+        SELECT EXISTS (SELECT 1 FROM transactions WHERE recurring_id = :id) AS has_linked
+    ), deleted AS (
+        DELETE FROM recurring_transactions
+        WHERE id = :id AND NOT (SELECT has_linked FROM linked)
+        RETURNING name, 'deleted' AS action
+    ), deactivated AS (
+        UPDATE recurring_transactions
+        SET is_active = false
+        WHERE id = :id AND (SELECT has_linked FROM linked)
+        RETURNING name, 'deactivated' AS action
+    )
+    SELECT name, action FROM deleted
+    UNION ALL
+    SELECT name, action FROM deactivated
+""")
 
-        db.commit()
-        return {
-            "message": f"Повторяющаяся транзакция '{result.name}' деактивирована (есть {linked_count} связанных транзакций)"
-        }
 
-    # Удаляем если нет связанных транзакций
-    result = db.execute(
-        text("DELETE FROM recurring_transactions WHERE id = :id RETURNING name"),
-        {"id": id}
-    ).fetchone()
+@router.delete("/{id}")
+def delete_recurring_transaction(id: int, db: Session = Depends(get_db)):
+    # Удаление или деактивация (если есть связанные транзакции) одним запросом
+    result = db.execute(DELETE_OR_DEACTIVATE_QUERY, {"id": id}).fetchone()
 
     if not result:
         raise HTTPException(status_code=404, detail="Повторяющаяся транзакция не найдена")
 
     db.commit()
+    if result.action == 'deactivated':
+        return {
+            "message": f"Повторяющаяся транзакция '{result.name}' деактивирована (есть связанные транзакции)"
+        }
     return {"message": f"Повторяющаяся транзакция '{result.name}' удалена"}
 
 
@@ -373,35 +466,18 @@ def update_recurring_transaction(
         recurring_update: RecurringTransactionUpdate,
         db: Session = Depends(get_db)
 ):
-    ensure_last_created_date_column(db)
-
     update_data = recurring_update.model_dump(exclude_unset=True)
     if not update_data:
         raise HTTPException(status_code=400, detail="Нет данных для обновления")
 
-    # Специальная обработка поля 'type'
-    if 'type' in update_data:
-        update_data['transaction_type'] = update_data.pop('type')
-
-    update_fields = []
-    params = {"id": id}
-
-    for field, value in update_data.items():
-        update_fields.append(f"{field} = :{field}")
-        params[field] = value
+    query = build_update_query("recurring_transactions", tuple(update_data), touch_updated_at=True)
+    params = {"id": id, **update_data}
 
-    query = f"""
-        UPDATE recurring_transactions
-        SET {', '.join(update_fields)}, updated_at = CURRENT_TIMESTAMP
-        WHERE id = :id
-        RETURNING *
-    """
-
-    result = db.execute(text(query), params)
+    result = db.execute(query, params)
     db.commit()
 
-    row = result.fetchone()
+    row = result.mappings().first()
     if not row:
         raise HTTPException(status_code=404, detail="Повторяющаяся транзакция не найдена")
 
-    return dict(row._asdict())
+    return row
@@ -1,11 +1,16 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from fastapi.responses import ORJSONResponse
 from typing import List, Dict, Any, Optional
 from sqlalchemy.orm import Session
 from sqlalchemy import text
 from dependencies import get_db
+from utils.sql import build_update_query
 from models.schemas import SavingsGoal, SavingsGoalCreate, SavingsGoalUpdate
+from routers.transactions import search_count_cache
+from routers.categories import categories_cache
 from datetime import date, datetime
 from decimal import Decimal
+import threading
 
 router = APIRouter(
     prefix="/savings-goals",
@@ -13,23 +18,78 @@ router = APIRouter(
 )
 
 
-@router.get("/", response_model=List[SavingsGoal])
+# В SET все выражения видят старые значения строки
+DEPOSIT_QUERY = text("""
+    UPDATE savings_goals
+    SET current_amount = current_amount + :amount,
+        is_achieved = current_amount + :amount >= target_amount,
+        achieved_at = CASE
+            WHEN current_amount + :amount >= target_amount THEN CURRENT_TIMESTAMP
+            ELSE achieved_at
+        END,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = :id AND NOT is_achieved
+    RETURNING current_amount, is_achieved, account_id, name
+""")
+
+# Категория для пополнений: upsert по частичному уникальному индексу (см. migrations.py).
+# DO UPDATE нужен, чтобы RETURNING вернул id и при конфликте
+SAVINGS_CATEGORY_QUERY = text("""
+    INSERT INTO categories (name, type, icon, color)
+    VALUES ('Пополнение цели', 'transfer', '🎯', '#007bff')
+    ON CONFLICT (name, type) WHERE name = 'Пополнение цели'
+    DO UPDATE SET name = EXCLUDED.name
+    RETURNING id
+""")
+
+# id категории пополнений не меняется, поэтому запоминается после первого обращения
+_savings_category_id: Optional[int] = None
+_savings_category_lock = threading.Lock()
+
+
+def get_savings_category_id(db: Session) -> int:
+    global _savings_category_id
+    if _savings_category_id is None:
+        with _savings_category_lock:
+            if _savings_category_id is None:
+                _savings_category_id = db.execute(SAVINGS_CATEGORY_QUERY).scalar()
+    return _savings_category_id
+
+
+def reset_savings_category_id():
+    """Сбрасывает id, например если категория была удалена или создана в откаченной транзакции"""
+    global _savings_category_id
+    _savings_category_id = None
+
+
+# Ответ - готовый JSON из json_agg, поэтому без response_model: схема не проверяется
+@router.get("/", response_class=ORJSONResponse)
 def get_savings_goals(
         include_achieved: bool = False,
+        limit: Optional[int] = Query(default=None, le=1000),  # По умолчанию весь список (LIMIT NULL)
+        offset: int = 0,
         db: Session = Depends(get_db)
 ):
     query = """
-        SELECT sg.*, a.name as account_name
+        SELECT
+            sg.id, sg.name, sg.target_amount, sg.current_amount, sg.target_date,
+            sg.account_id, sg.notes, sg.is_achieved, sg.created_at, sg.achieved_at,
+            a.name as account_name
         FROM savings_goals sg
         LEFT JOIN accounts a ON sg.account_id = a.id
         WHERE 1=1
     """
-    params = {}
+    params = {"limit": limit, "offset": offset}
     if not include_achieved:
         query += " AND sg.is_achieved = false"
-    query += " ORDER BY sg.target_date NULLS LAST, sg.created_at DESC"
-    result = db.execute(text(query), params)
-    return [dict(row._asdict()) for row in result]
+    query += " ORDER BY sg.target_date NULLS LAST, sg.created_at DESC LIMIT :limit OFFSET :offset"
+
+    # JSON собирается в Postgres, Python только передает готовую строку
+    payload = db.execute(
+        text(f"SELECT COALESCE(json_agg(t), '[]'::json)::text FROM ({query}) t"),
+        params
+    ).scalar()
+    return Response(content=payload, media_type="application/json")
 
 
 @router.post("/", response_model=SavingsGoal)
@@ -55,28 +115,17 @@ def update_savings_goal(
     if not update_data:
         raise HTTPException(status_code=400, detail="Нет данных для обновления")
 
-    update_fields = []
-    params = {"id": goal_id}
+    query = build_update_query("savings_goals", tuple(update_data), touch_updated_at=True)
+    params = {"id": goal_id, **update_data}
 
-    for field, value in update_data.items():
-        update_fields.append(f"{field} = :{field}")
-        params[field] = value
-
-    query = f"""
-        UPDATE savings_goals
-        SET {', '.join(update_fields)}, updated_at = CURRENT_TIMESTAMP
-        WHERE id = :id
-        RETURNING *
-    """
-
-    result = db.execute(text(query), params)
+    result = db.execute(query, params)
     db.commit()
 
-    row = result.fetchone()
+    row = result.mappings().first()
     if not row:
         raise HTTPException(status_code=404, detail="Цель накопления не найдена")
 
-    return dict(row._asdict())
+    return row
 
 
 @router.post("/{goal_id}/deposit")
@@ -88,52 +137,24 @@ def deposit_to_savings_goal(
 ):
     trans = db.begin()
     try:
-        goal = db.execute(
-            text("SELECT * FROM savings_goals WHERE id = :id FOR UPDATE"),
-            {"id": goal_id}
-        ).fetchone()
+        # Пересчет суммы и статуса одним UPDATE вместо SELECT ... FOR UPDATE + UPDATE
+        goal = db.execute(DEPOSIT_QUERY, {"id": goal_id, "amount": amount}).fetchone()
 
         if not goal:
-            raise HTTPException(status_code=404, detail="Цель накопления не найдена")
-
-        if goal.is_achieved:
+            exists = db.execute(
+                text("SELECT 1 FROM savings_goals WHERE id = :id"),
+                {"id": goal_id}
+            ).scalar()
+            if not exists:
+                raise HTTPException(status_code=404, detail="Цель накопления не найдена")
             raise HTTPException(status_code=400, detail="Цель уже достигнута.")
 
-        new_current_amount = goal.current_amount + amount
-        is_achieved = new_current_amount >= goal.target_amount
-        achieved_at = datetime.now() if is_achieved else None
-
-        db.execute(
-            text("""
-                UPDATE savings_goals
-                SET current_amount = :new_current_amount,
-                    is_achieved = :is_achieved,
-                    achieved_at = :achieved_at,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE id = :id
-            """),
-            {
-                "new_current_amount": new_current_amount,
-                "is_achieved": is_achieved,
-                "achieved_at": achieved_at,
-                "id": goal_id
-            }
-        )
-
         # Optionally, create a transaction for this deposit if not linked
+        category_created = False
         if not transaction_id and goal.account_id:
-            category_id = db.execute(
-                text("SELECT id FROM categories WHERE name = 'Пополнение цели' AND type = 'transfer'")
-            ).scalar()
-            if not category_id:
-                new_cat = db.execute(
-                    text("""
-                        INSERT INTO categories (name, type, icon, color)
-                        VALUES ('Пополнение цели', 'transfer', '🎯', '#007bff')
-                        RETURNING id
-                    """)
-                ).fetchone()
-                category_id = new_cat[0]
+            # Первое обращение в процессе может создать категорию пополнений
+            category_created = _savings_category_id is None
+            category_id = get_savings_category_id(db)
 
             db.execute(text("""
                 INSERT INTO transactions (date, type, amount, account_from_id, account_to_id, category_id, description, is_planned)
@@ -148,10 +169,18 @@ def deposit_to_savings_goal(
             # You might need a more complex system to represent this as a transfer within accounts if the goal is a "virtual account".
 
         trans.commit()
-        return {"message": "Цель накопления пополнена", "current_amount": new_current_amount,
-                "is_achieved": is_achieved}
+        if not transaction_id and goal.account_id:
+            search_count_cache.clear()
+        if category_created:
+            categories_cache.clear()
+        return {"message": "Цель накопления пополнена", "current_amount": goal.current_amount,
+                "is_achieved": goal.is_achieved}
+    except HTTPException:
+        trans.rollback()
+        raise
     except Exception as e:
         trans.rollback()
+        reset_savings_category_id()
         raise HTTPException(status_code=500, detail=f"Ошибка при пополнении цели накопления: {str(e)}")
 
 
@@ -10,33 +10,51 @@ router = APIRouter(
     tags=["Tags"]
 )
 
+SELECT_TAGS_QUERY = text("SELECT * FROM tags ORDER BY name")
+
+INSERT_TAG_QUERY = text("""
+    INSERT INTO tags (name, color)
+    VALUES (:name, :color)
+    ON CONFLICT ((lower(name))) DO NOTHING
+    RETURNING *
+""")
+
+# Одна форма запроса для любого набора полей, как в UPDATE_TRANSACTION_QUERY
+UPDATE_TAG_QUERY = text("""
+    UPDATE tags
+    SET name = CASE WHEN :set_name THEN :name ELSE name END,
+        color = CASE WHEN :set_color THEN :color ELSE color END,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = :id
+    RETURNING *
+""")
+
+DELETE_TAG_QUERY = text("""
+    WITH deleted AS (
+        DELETE FROM tags
+        WHERE id = :id
+          AND NOT EXISTS (SELECT 1 FROM transaction_tags WHERE tag_id = :id)
+        RETURNING id
+    )
+    SELECT
+        (SELECT id FROM deleted) AS deleted_id,
+        EXISTS (SELECT 1 FROM transaction_tags WHERE tag_id = :id) AS in_use
+""")
+
 
 @router.get("/", response_model=List[Tag])
 def get_tags(db: Session = Depends(get_db)):
-    query = "SELECT * FROM tags ORDER BY name"
-    result = db.execute(text(query))
-    return [dict(row._asdict()) for row in result]
+    return db.execute(SELECT_TAGS_QUERY).mappings().all()
 
 
 @router.post("/", response_model=Tag)
 def create_tag(tag: TagCreate, db: Session = Depends(get_db)):
-    # Check if tag already exists (case-insensitive)
-    existing_tag = db.execute(
-        text("SELECT id FROM tags WHERE lower(name) = lower(:name)"),
-        {"name": tag.name}
-    ).scalar()
-    if existing_tag:
+    # Уникальность без учета регистра обеспечивает индекс tags_lower_name_uidx
+    row = db.execute(INSERT_TAG_QUERY, tag.model_dump()).mappings().first()
+    if not row:
         raise HTTPException(status_code=409, detail="Тег с таким именем уже существует")
-
-    query = """
-        INSERT INTO tags (name, color)
-        VALUES (:name, :color)
-        RETURNING *
-    """
-    params = tag.model_dump()
-    result = db.execute(text(query), params)
     db.commit()
-    return dict(result.fetchone()._asdict())
+    return row
 
 
 @router.put("/{tag_id}", response_model=Tag)
@@ -49,50 +67,33 @@ def update_tag(
     if not update_data:
         raise HTTPException(status_code=400, detail="Нет данных для обновления")
 
-    update_fields = []
-    params = {"id": tag_id}
-
-    for field, value in update_data.items():
-        update_fields.append(f"{field} = :{field}")
-        params[field] = value
-
-    query = f"""
-        UPDATE tags
-        SET {', '.join(update_fields)}, updated_at = CURRENT_TIMESTAMP
-        WHERE id = :id
-        RETURNING *
-    """
-
-    result = db.execute(text(query), params)
+    result = db.execute(UPDATE_TAG_QUERY, {
+        "id": tag_id,
+        "set_name": "name" in update_data,
+        "name": update_data.get("name"),
+        "set_color": "color" in update_data,
+        "color": update_data.get("color"),
+    })
     db.commit()
 
-    row = result.fetchone()
+    row = result.mappings().first()
     if not row:
         raise HTTPException(status_code=404, detail="Тег не найден")
 
-    return dict(row._asdict())
+    return row
 
 
 @router.delete("/{tag_id}")
 def delete_tag(tag_id: int, db: Session = Depends(get_db)):
-    # Check if any transactions are associated with this tag
-    count = db.execute(
-        text("SELECT COUNT(*) FROM transaction_tags WHERE tag_id = :id"),
-        {"id": tag_id}
-    ).scalar()
+    # Проверка связанных транзакций и удаление одним запросом
+    result = db.execute(DELETE_TAG_QUERY, {"id": tag_id}).fetchone()
 
-    if count > 0:
+    if result.in_use:
         raise HTTPException(
             status_code=400,
-            detail=f"Невозможно удалить тег. Существует {count} транзакций, связанных с этим тегом."
+            detail="Невозможно удалить тег. Существуют транзакции, связанные с этим тегом."
         )
-
-    result = db.execute(
-        text("DELETE FROM tags WHERE id = :id RETURNING id"),
-        {"id": tag_id}
-    )
-    deleted = result.fetchone()
-    if not deleted:
+    if result.deleted_id is None:
         raise HTTPException(status_code=404, detail="Тег не найден")
     db.commit()
     return {"message": "Тег удален"}
@@ -1,13 +1,18 @@
 from datetime import date
 from decimal import Decimal
 
-from fastapi import APIRouter, Depends, Query, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, Query, HTTPException, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
-from typing import List, Optional
+from sqlalchemy.sql.elements import TextClause
+from typing import List, Optional, Tuple
+from functools import lru_cache
+from cachetools import TTLCache
 
-from dependencies import get_db
+from dependencies import get_async_db
 from models.schemas import Transaction, TransactionCreate, TransactionUpdate
+from utils.enums import TransactionType
+from utils.pagination import encode_cursor, decode_cursor
 
 router = APIRouter(
     prefix="/transactions",
@@ -18,312 +23,241 @@ router = APIRouter(
 # You will need to implement GET, POST, PUT, DELETE for transactions here.
 # The original search endpoint is moved to data_ops.py.
 
+# total для search_transactions по набору фильтров; сбрасывается при любом добавлении, изменении или
+# удалении транзакций, в том числе из импорта, повторяющихся транзакций, целей и корректировок
+search_count_cache = TTLCache(maxsize=256, ttl=30)
+
+# Строки транзакций с названиями и тегами: одна транзакция, списки и поиск
+TRANSACTIONS_SELECT_SQL = """
+    SELECT
+        t.*,
+        c.name as category_name,
+        c.icon as category_icon,
+        c.color as category_color,
+        sc.name as subcategory_name,
+        af.name as account_from_name,
+        at.name as account_to_name,
+        tag_agg.tags
+    FROM transactions t
+    LEFT JOIN categories c ON t.category_id = c.id
+    LEFT JOIN categories sc ON t.subcategory_id = sc.id
+    LEFT JOIN accounts af ON t.account_from_id = af.id
+    LEFT JOIN accounts at ON t.account_to_id = at.id
+    LEFT JOIN LATERAL (
+        SELECT array_agg(tg.name ORDER BY tg.name) AS tags
+        FROM transaction_tags tt
+        JOIN tags tg ON tg.id = tt.tag_id
+        WHERE tt.transaction_id = t.id
+    ) tag_agg ON true
+"""
+
+GET_TRANSACTION_QUERY = text(TRANSACTIONS_SELECT_SQL + " WHERE t.id = :id")
+
+LOCK_TRANSACTION_QUERY = text(
+    "SELECT id, amount, account_from_id, account_to_id FROM transactions WHERE id = :id FOR UPDATE"
+)
+
+# Одна форма запроса для любого набора полей: флаг set_* решает, менять ли поле,
+# поэтому явный null (очистка заметки) тоже поддерживается
+UPDATE_TRANSACTION_QUERY = text("""
+    UPDATE transactions
+    SET description = CASE WHEN :set_description THEN :description ELSE description END,
+        notes = CASE WHEN :set_notes THEN :notes ELSE notes END,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = :id
+    RETURNING *
+""")
+
+DELETE_TRANSACTION_TAGS_QUERY = text("DELETE FROM transaction_tags WHERE transaction_id = :id")
+
+DELETE_TRANSACTION_QUERY = text("DELETE FROM transactions WHERE id = :id RETURNING id")
+
+CREATE_TRANSACTION_QUERY = text("""
+    SELECT * FROM create_transaction_fn(
+        :date, :transaction_type, :amount, :account_from_id, :account_to_id,
+        :category_id, :subcategory_id, :description, :notes, :is_planned,
+        CAST(:tag_ids AS int[])
+    )
+""")
+
+# Подзапросы CTE выполняются на одном снимке в непредсказуемом порядке, поэтому
+# удаляются только теги не из нового набора, а вставляются только отсутствующие
+REPLACE_TAGS_QUERY = text("""
+    WITH deleted AS (
+        DELETE FROM transaction_tags
+        WHERE transaction_id = :transaction_id
+          AND tag_id <> ALL(CAST(:tag_ids AS int[]))
+    )
+    INSERT INTO transaction_tags (transaction_id, tag_id)
+    SELECT DISTINCT CAST(:transaction_id AS int), new.tag_id
+    FROM unnest(CAST(:tag_ids AS int[])) AS new(tag_id)
+    WHERE NOT EXISTS (
+        SELECT 1 FROM transaction_tags tt
+        WHERE tt.transaction_id = :transaction_id AND tt.tag_id = new.tag_id
+    )
+""")
+# Суммирование по id: перевод на тот же счет или откат + новое значение дают одну строку
+UPDATE_BALANCES_QUERY = text("""
+    UPDATE accounts a
+    SET current_balance = a.current_balance + d.delta, updated_at = CURRENT_TIMESTAMP
+    FROM (
+        SELECT id, SUM(delta) AS delta
+        FROM unnest(CAST(:ids AS int[]), CAST(:deltas AS numeric[])) AS v(id, delta)
+        GROUP BY id
+    ) d
+    WHERE a.id = d.id
+""")
+
+
+async def apply_balance_deltas(db: AsyncSession, deltas: List[Tuple[Optional[int], Decimal]]):
+    """Изменяет балансы счетов одним UPDATE; пары без счета и нулевые итоги пропускаются"""
+    net = {}
+    for account_id, delta in deltas:
+        if account_id:
+            net[account_id] = net.get(account_id, 0) + delta
+    net = {account_id: delta for account_id, delta in net.items() if delta}
+    if net:
+        await db.execute(UPDATE_BALANCES_QUERY, {"ids": list(net), "deltas": list(net.values())})
+
+
+def parse_cursor(cursor: str) -> dict:
+    """Параметры keyset-фильтра (t.date, t.id) < (:cursor_date, :cursor_id)"""
+    try:
+        cursor_date, cursor_id = decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"cursor_date": cursor_date, "cursor_id": cursor_id}
+
+
 @router.get("/", response_model=List[Transaction])
-def get_all_transactions(
-        limit: int = Query(default=50, le=500),
-        offset: int = 0,
-        db: Session = Depends(get_db)
+async def get_all_transactions(
+        response: Response,
+        limit: int = Query(default=50, ge=1, le=500),
+        offset: int = 0,  # Устарело: используйте cursor
+        cursor: Optional[str] = Query(None, description="Курсор из заголовка X-Next-Cursor"),
+        db: AsyncSession = Depends(get_async_db)
 ):
-    query = """
-        SELECT
-            t.*, -- Now t.date will be returned
-            c.name as category_name,
-            c.icon as category_icon,
-            c.color as category_color,
-            sc.name as subcategory_name,
-            af.name as account_from_name,
-            at.name as account_to_name,
-            array_agg(DISTINCT tg.name) FILTER (WHERE tg.name IS NOT NULL) as tags
-        FROM transactions t
-        LEFT JOIN categories c ON t.category_id = c.id
-        LEFT JOIN categories sc ON t.subcategory_id = sc.id
-        LEFT JOIN accounts af ON t.account_from_id = af.id
-        LEFT JOIN accounts at ON t.account_to_id = at.id
-        LEFT JOIN transaction_tags tt ON t.id = tt.transaction_id
-        LEFT JOIN tags tg ON tt.tag_id = tg.id
-        GROUP BY t.id, c.name, c.icon, c.color, sc.name, af.name, at.name
-        ORDER BY t.date DESC -- Only order by date now
+    params = {"limit": limit, "offset": offset}
+    where = ""
+    if cursor:
+        # Keyset-пагинация: поиск по индексу (date DESC, id DESC) вместо пропуска offset строк
+        params.update(parse_cursor(cursor), offset=0)
+        where = "WHERE (t.date, t.id) < (:cursor_date, :cursor_id)"
+
+    # Сортировка по индексу (date DESC, id DESC): LIMIT ограничивает соединения и теги страницей
+    query = TRANSACTIONS_SELECT_SQL + f"""
+        {where}
+        ORDER BY t.date DESC, t.id DESC
         LIMIT :limit OFFSET :offset
     """
-    result = db.execute(text(query), {"limit": limit, "offset": offset})
-    return [dict(row._asdict()) for row in result]
+    rows = (await db.execute(text(query), params)).mappings().all()
+
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(rows[-1]["date"], rows[-1]["id"])
+    return rows
 
 
 @router.post("/", response_model=Transaction)
-def create_transaction(transaction: TransactionCreate, db: Session = Depends(get_db)):
-    trans = db.begin()
-    try:
-        # Insert transaction
-        query = """
-            INSERT INTO transactions (
-                date, type, amount, account_from_id, account_to_id,
-                category_id, subcategory_id, description, notes, is_planned
-            ) VALUES (
-                :date, :transaction_type, :amount, :account_from_id, :account_to_id,
-                :category_id, :subcategory_id, :description, :notes, :is_planned
-            ) RETURNING id, date, type, amount, account_from_id, account_to_id, category_id, subcategory_id, description, notes, is_planned,  created_at, updated_at
-        """
-        params = transaction.model_dump(exclude={"tag_ids"})
-        params['transaction_type'] = params.pop('type', None)  # Renaming 'type' for SQL
-        result = db.execute(text(query), params)
-        new_transaction = result.fetchone()
+async def create_transaction(transaction: TransactionCreate, db: AsyncSession = Depends(get_async_db)):
+    # Транзакция, теги и балансы создаются одной функцией БД (см. migrations.py)
+    params = transaction.model_dump(exclude={"tag_ids"})
+    params['transaction_type'] = params.pop('type', None)  # Renaming 'type' for SQL
+    params['tag_ids'] = transaction.tag_ids or []
+    async with db.begin():
+        new_transaction = (await db.execute(CREATE_TRANSACTION_QUERY, params)).mappings().first()
 
         if not new_transaction:
             raise HTTPException(status_code=500, detail="Failed to create transaction")
 
-        transaction_id = new_transaction.id
-
-        # Handle tags
-        if transaction.tag_ids:
-            tag_insert_values = [
-                {"transaction_id": transaction_id, "tag_id": tag_id}
-                for tag_id in transaction.tag_ids
-            ]
-            db.execute(text("""
-                INSERT INTO transaction_tags (transaction_id, tag_id)
-                VALUES (:transaction_id, :tag_id)
-            """), tag_insert_values)
-
-        # Update account balances
-        if transaction.account_from_id:
-            db.execute(
-                text(
-                    "UPDATE accounts SET current_balance = current_balance - :amount, updated_at = CURRENT_TIMESTAMP WHERE id = :id"),
-                {"amount": transaction.amount, "id": transaction.account_from_id}
-            )
-        if transaction.account_to_id:
-            db.execute(
-                text(
-                    "UPDATE accounts SET current_balance = current_balance + :amount, updated_at = CURRENT_TIMESTAMP WHERE id = :id"),
-                {"amount": transaction.amount, "id": transaction.account_to_id}
-            )
-
-        trans.commit()
-        return dict(new_transaction._asdict())
-
-    except Exception as e:
-        trans.rollback()
-        print(e)
-        raise HTTPException(status_code=500, detail=f"Failed to create transaction: {str(e)}")
+    search_count_cache.clear()
+    return new_transaction
 
 
 @router.get("/{transaction_id}", response_model=Transaction)
-def get_transaction(transaction_id: int, db: Session = Depends(get_db)):
-    query = """
-        SELECT
-            t.*,
-            c.name as category_name,
-            c.icon as category_icon,
-            c.color as category_color,
-            sc.name as subcategory_name,
-            af.name as account_from_name,
-            at.name as account_to_name,
-            array_agg(DISTINCT tg.name) FILTER (WHERE tg.name IS NOT NULL) as tags
-        FROM transactions t
-        LEFT JOIN categories c ON t.category_id = c.id
-        LEFT JOIN categories sc ON t.subcategory_id = sc.id
-        LEFT JOIN accounts af ON t.account_from_id = af.id
-        LEFT JOIN accounts at ON t.account_to_id = at.id
-        LEFT JOIN transaction_tags tt ON t.id = tt.transaction_id
-        LEFT JOIN tags tg ON tt.tag_id = tg.id
-        WHERE t.id = :id
-        GROUP BY t.id, c.name, c.icon, c.color, sc.name, af.name, at.name
-    """
-    result = db.execute(text(query), {"id": transaction_id}).fetchone()
+async def get_transaction(transaction_id: int, db: AsyncSession = Depends(get_async_db)):
+    result = (await db.execute(GET_TRANSACTION_QUERY, {"id": transaction_id})).mappings().first()
     if not result:
         raise HTTPException(status_code=404, detail="Транзакция не найдена")
-    return dict(result._asdict())
+    return result
 
 
 @router.put("/{transaction_id}", response_model=Transaction)
-def update_transaction(
+async def update_transaction(
         transaction_id: int,
         transaction_update: TransactionUpdate,
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_async_db)
 ):
-    trans = db.begin()
-    try:
-        # Get current transaction data to reverse old balance changes
-        old_transaction = db.execute(
-            text("SELECT * FROM transactions WHERE id = :id FOR UPDATE"),
-            {"id": transaction_id}
-        ).fetchone()
-
-        if not old_transaction:
+    update_data = transaction_update.model_dump(exclude_unset=True)
+    if not update_data and not transaction_update.tag_ids:
+        raise HTTPException(status_code=400, detail="Нет данных для обновления")
+
+    # Commit on success, rollback on any exception (including HTTPException).
+    # TransactionUpdate has no amount or account fields, so balances are not touched
+    async with db.begin():
+        # Update transaction details (excluding tags for now).
+        # If only tags are updated, only updated_at is touched: RETURNING * still
+        # gives the full row for the response
+        updated_transaction = (await db.execute(UPDATE_TRANSACTION_QUERY, {
+            "id": transaction_id,
+            "set_description": "description" in update_data,
+            "description": update_data.get("description"),
+            "set_notes": "notes" in update_data,
+            "notes": update_data.get("notes"),
+        })).mappings().first()
+
+        if not updated_transaction:
             raise HTTPException(status_code=404, detail="Транзакция не найдена")
 
-        # Revert old balance changes
-        if old_transaction.account_from_id:
-            db.execute(
-                text("UPDATE accounts SET current_balance = current_balance + :amount WHERE id = :id"),
-                {"amount": old_transaction.amount, "id": old_transaction.account_from_id}
-            )
-        if old_transaction.account_to_id:
-            db.execute(
-                text("UPDATE accounts SET current_balance = current_balance - :amount WHERE id = :id"),
-                {"amount": old_transaction.amount, "id": old_transaction.account_to_id}
-            )
-
-        update_data = transaction_update.model_dump(exclude_unset=True)
-        if not update_data and not transaction_update.tag_ids:
-            raise HTTPException(status_code=400, detail="Нет данных для обновления")
-
-        # Update transaction details (excluding tags for now)
-        transaction_fields_to_update = {k: v for k, v in update_data.items() if k != "tag_ids"}
-        if transaction_fields_to_update:
-            update_fields = []
-            params = {"id": transaction_id}
-            for field, value in transaction_fields_to_update.items():
-                update_fields.append(f"{field} = :{field}")
-                params[field] = value
-            query = f"""
-                UPDATE transactions
-                SET {', '.join(update_fields)}, updated_at = CURRENT_TIMESTAMP
-                WHERE id = :id
-                RETURNING *
-            """
-            result = db.execute(text(query), params)
-            updated_transaction = result.fetchone()
-        else:
-            updated_transaction = old_transaction  # If only tags are updated
-
-        # Handle tag updates: delete old tags and insert new ones
+        # Handle tag updates: replace the tag set in one statement
         if transaction_update.tag_ids is not None:  # If tag_ids is explicitly provided
-            db.execute(
-                text("DELETE FROM transaction_tags WHERE transaction_id = :transaction_id"),
-                {"transaction_id": transaction_id}
-            )
-            if transaction_update.tag_ids:
-                tag_insert_values = [
-                    {"transaction_id": transaction_id, "tag_id": tag_id}
-                    for tag_id in transaction_update.tag_ids
-                ]
-                db.execute(text("""
-                    INSERT INTO transaction_tags (transaction_id, tag_id)
-                    VALUES (:transaction_id, :tag_id)
-                """), tag_insert_values)
-
-        # Apply new balance changes based on the updated transaction
-        current_transaction_data = db.execute(
-            text("SELECT * FROM transactions WHERE id = :id"),
-            {"id": transaction_id}
-        ).fetchone()
-
-        if current_transaction_data.account_from_id:
-            db.execute(
-                text(
-                    "UPDATE accounts SET current_balance = current_balance - :amount, updated_at = CURRENT_TIMESTAMP WHERE id = :id"),
-                {"amount": current_transaction_data.amount, "id": current_transaction_data.account_from_id}
-            )
-        if current_transaction_data.account_to_id:
-            db.execute(
-                text(
-                    "UPDATE accounts SET current_balance = current_balance + :amount, updated_at = CURRENT_TIMESTAMP WHERE id = :id"),
-                {"amount": current_transaction_data.amount, "id": current_transaction_data.account_to_id}
-            )
+            await db.execute(REPLACE_TAGS_QUERY, {
+                "transaction_id": transaction_id, "tag_ids": transaction_update.tag_ids
+            })
 
-        trans.commit()
-        return dict(current_transaction_data._asdict())
-
-    except Exception as e:
-        trans.rollback()
-        raise HTTPException(status_code=500, detail=f"Failed to update transaction: {str(e)}")
+    # Поиск фильтрует по описанию, заметкам и тегам
+    search_count_cache.clear()
+    return updated_transaction
 
 
 @router.delete("/{transaction_id}")
-def delete_transaction(transaction_id: int, db: Session = Depends(get_db)):
-    trans = db.begin()
-    try:
+async def delete_transaction(transaction_id: int, db: AsyncSession = Depends(get_async_db)):
+    async with db.begin():
         # Get transaction details to revert balance changes
-        transaction_to_delete = db.execute(
-            text("SELECT * FROM transactions WHERE id = :id FOR UPDATE"),
-            {"id": transaction_id}
-        ).fetchone()
+        transaction_to_delete = (await db.execute(LOCK_TRANSACTION_QUERY, {"id": transaction_id})).fetchone()
 
         if not transaction_to_delete:
             raise HTTPException(status_code=404, detail="Транзакция не найдена")
 
         # Revert balance changes
-        if transaction_to_delete.account_from_id:
-            db.execute(
-                text("UPDATE accounts SET current_balance = current_balance + :amount WHERE id = :id"),
-                {"amount": transaction_to_delete.amount, "id": transaction_to_delete.account_from_id}
-            )
-        if transaction_to_delete.account_to_id:
-            db.execute(
-                text("UPDATE accounts SET current_balance = current_balance - :amount WHERE id = :id"),
-                {"amount": transaction_to_delete.amount, "id": transaction_to_delete.account_to_id}
-            )
+        await apply_balance_deltas(db, [
+            (transaction_to_delete.account_from_id, transaction_to_delete.amount),
+            (transaction_to_delete.account_to_id, -transaction_to_delete.amount),
+        ])
 
         # Delete associated tags first
-        db.execute(
-            text("DELETE FROM transaction_tags WHERE transaction_id = :id"),
-            {"id": transaction_id}
-        )
+        await db.execute(DELETE_TRANSACTION_TAGS_QUERY, {"id": transaction_id})
 
         # Delete the transaction
-        result = db.execute(
-            text("DELETE FROM transactions WHERE id = :id RETURNING id"),
-            {"id": transaction_id}
-        )
-        deleted = result.fetchone()
+        deleted = (await db.execute(DELETE_TRANSACTION_QUERY, {"id": transaction_id})).fetchone()
         if not deleted:
             # This case should ideally not be reached if transaction_to_delete was found
             raise HTTPException(status_code=404, detail="Транзакция не найдена после попытки удаления")
 
-        trans.commit()
-        return {"message": "Транзакция удалена и балансы счетов скорректированы"}
-
-    except Exception as e:
-        trans.rollback()
-        raise HTTPException(status_code=500, detail=f"Ошибка при удалении транзакции: {str(e)}")
+    search_count_cache.clear()
+    return {"message": "Транзакция удалена и балансы счетов скорректированы"}
 
 
-@router.get("/search/transactions")
-def search_transactions(
-        q: Optional[str] = Query(None, description="Поисковый запрос"),
-        start_date: Optional[date] = None,
-        end_date: Optional[date] = None,
-        min_amount: Optional[Decimal] = None,
-        max_amount: Optional[Decimal] = None,
-        account_ids: Optional[str] = Query(None),  # Changed to str to handle comma-separated values
-        category_ids: Optional[str] = Query(None),  # Changed to str
-        tag_ids: Optional[str] = Query(None),  # Changed to str
-        transaction_types: Optional[str] = Query(None),  # Changed to str
-        limit: int = Query(default=50, le=500),
-        offset: int = 0,
-        db: Session = Depends(get_db)
-):
-    # Parse comma-separated IDs
-    account_ids_list = [int(x) for x in account_ids.split(',')] if account_ids else None
-    category_ids_list = [int(x) for x in category_ids.split(',')] if category_ids else None
-    tag_ids_list = [int(x) for x in tag_ids.split(',')] if tag_ids else None
-    transaction_types_list = transaction_types.split(',') if transaction_types else None
-
-    query = """
-        SELECT DISTINCT
-            t.*,
-            c.name as category_name,
-            c.icon as category_icon,
-            c.color as category_color,
-            sc.name as subcategory_name,
-            af.name as account_from_name,
-            at.name as account_to_name,
-            array_agg(DISTINCT tg.name) FILTER (WHERE tg.name IS NOT NULL) as tags
-        FROM transactions t
-        LEFT JOIN categories c ON t.category_id = c.id
-        LEFT JOIN categories sc ON t.subcategory_id = sc.id
-        LEFT JOIN accounts af ON t.account_from_id = af.id
-        LEFT JOIN accounts at ON t.account_to_id = at.id
-        LEFT JOIN transaction_tags tt ON t.id = tt.transaction_id
-        LEFT JOIN tags tg ON tt.tag_id = tg.id
-        WHERE 1=1
-    """
-    params = {"limit": limit, "offset": offset}
+@lru_cache(maxsize=512)
+def _search_where_sql(
+        has_q: bool, has_start: bool, has_end: bool, has_min: bool, has_max: bool,
+        has_accounts: bool, has_categories: bool, has_types: bool, has_tags: bool
+) -> str:
+    """WHERE для search_transactions; зависит только от набора заданных фильтров"""
+    where = " WHERE 1=1"
 
     # Текстовый поиск
-    if q:
-        query += """
+    if has_q:
+        where += """
             AND (
                 t.description ILIKE :search_query
                 OR t.notes ILIKE :search_query
@@ -332,102 +266,132 @@ def search_transactions(
                 OR at.name ILIKE :search_query
             )
         """
-        params["search_query"] = f"%{q}%"
 
     # Фильтры по датам
-    if start_date:
-        query += " AND t.date >= :start_date"
-        params["start_date"] = start_date
-
-    if end_date:
-        query += " AND t.date <= :end_date"
-        params["end_date"] = end_date
+    if has_start:
+        where += " AND t.date >= :start_date"
+    if has_end:
+        where += " AND t.date <= :end_date"
 
     # Фильтры по суммам
-    if min_amount is not None:
-        query += " AND t.amount >= :min_amount"
-        params["min_amount"] = min_amount
-
-    if max_amount is not None:
-        query += " AND t.amount <= :max_amount"
-        params["max_amount"] = max_amount
+    if has_min:
+        where += " AND t.amount >= :min_amount"
+    if has_max:
+        where += " AND t.amount <= :max_amount"
+
+    # Фильтры по счетам, категориям и типам
+    if has_accounts:
+        where += " AND (t.account_from_id = ANY(:account_ids) OR t.account_to_id = ANY(:account_ids))"
+    if has_categories:
+        where += " AND (t.category_id = ANY(:category_ids) OR t.subcategory_id = ANY(:category_ids))"
+    if has_types:
+        where += " AND t.type = ANY(:transaction_types)"
 
-    # Фильтры по счетам
-    if account_ids_list:
-        query += " AND (t.account_from_id = ANY(:account_ids) OR t.account_to_id = ANY(:account_ids))"
-        params["account_ids"] = account_ids_list
-
-    # Фильтры по категориям
-    if category_ids_list:
-        query += " AND (t.category_id = ANY(:category_ids) OR t.subcategory_id = ANY(:category_ids))"
-        params["category_ids"] = category_ids_list
+    # Фильтры по тегам
+    if has_tags:
+        where += " AND EXISTS (SELECT 1 FROM transaction_tags tt2 WHERE tt2.transaction_id = t.id AND tt2.tag_id = ANY(:tag_ids))"
 
-    # Фильтры по типам
-    if transaction_types_list:
-        query += " AND t.type = ANY(:transaction_types)"
-        params["transaction_types"] = transaction_types_list
+    return where
 
-    # Фильтры по тегам
-    if tag_ids_list:
-        query += " AND EXISTS (SELECT 1 FROM transaction_tags tt2 WHERE tt2.transaction_id = t.id AND tt2.tag_id = ANY(:tag_ids))"
-        params["tag_ids"] = tag_ids_list
 
+@lru_cache(maxsize=1024)
+def _search_page_query(has_cursor: bool, *filters: bool) -> TextClause:
+    """Страница результатов; text() собирается один раз на комбинацию фильтров"""
+    query = TRANSACTIONS_SELECT_SQL + _search_where_sql(*filters)
+    if has_cursor:
+        query += " AND (t.date, t.id) < (:cursor_date, :cursor_id)"
     query += """
-        GROUP BY t.id, c.name, c.icon, c.color, sc.name, af.name, at.name
-        ORDER BY t.date DESC
+        ORDER BY t.date DESC, t.id DESC
         LIMIT :limit OFFSET :offset
     """
+    return text(query)
 
-    result = db.execute(text(query), params)
 
-    # Получаем общее количество
-    count_query = """
-        SELECT COUNT(DISTINCT t.id)
+@lru_cache(maxsize=512)
+def _search_count_query(*filters: bool) -> TextClause:
+    # Теги в WHERE не нужны, LATERAL для подсчета не соединяется
+    return text("""
+        SELECT COUNT(*)
         FROM transactions t
         LEFT JOIN categories c ON t.category_id = c.id
         LEFT JOIN accounts af ON t.account_from_id = af.id
         LEFT JOIN accounts at ON t.account_to_id = at.id
-        LEFT JOIN transaction_tags tt ON t.id = tt.transaction_id
-        WHERE 1=1
-    """
+    """ + _search_where_sql(*filters))
 
-    # Re-apply filters for the count query
-    count_params = {k: v for k, v in params.items() if k not in ['limit', 'offset']}
 
-    if q:
-        count_query += """
-            AND (
-                t.description ILIKE :search_query
-                OR t.notes ILIKE :search_query
-                OR c.name ILIKE :search_query
-                OR af.name ILIKE :search_query
-                OR at.name ILIKE :search_query
-            )
-        """
-    if start_date:
-        count_query += " AND t.date >= :start_date"
-    if end_date:
-        count_query += " AND t.date <= :end_date"
-    if min_amount is not None:
-        count_query += " AND t.amount >= :min_amount"
-    if max_amount is not None:
-        count_query += " AND t.amount <= :max_amount"
-    if account_ids_list:
-        count_query += " AND (t.account_from_id = ANY(:account_ids) OR t.account_to_id = ANY(:account_ids))"
-    if category_ids_list:
-        count_query += " AND (t.category_id = ANY(:category_ids) OR t.subcategory_id = ANY(:category_ids))"
-    if transaction_types_list:
-        count_query += " AND t.type = ANY(:transaction_types)"
-    if tag_ids_list:
-        count_query += " AND EXISTS (SELECT 1 FROM transaction_tags tt2 WHERE tt2.transaction_id = t.id AND tt2.tag_id = ANY(:tag_ids))"
-
-    total_count = db.execute(text(count_query), count_params).scalar()
-
-    transactions = [dict(row._asdict()) for row in result]
+@router.get("/search/transactions")
+async def search_transactions(
+        q: Optional[str] = Query(None, description="Поисковый запрос"),
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        min_amount: Optional[Decimal] = None,
+        max_amount: Optional[Decimal] = None,
+        account_ids: Optional[str] = Query(None),  # Changed to str to handle comma-separated values
+        category_ids: Optional[str] = Query(None),  # Changed to str
+        tag_ids: Optional[str] = Query(None),  # Changed to str
+        transaction_types: Optional[str] = Query(None),  # Changed to str
+        limit: int = Query(default=50, ge=1, le=500),
+        offset: int = 0,  # Устарело: используйте cursor
+        cursor: Optional[str] = Query(None, description="next_cursor из предыдущего ответа"),
+        db: AsyncSession = Depends(get_async_db)
+):
+    # Parse comma-separated IDs; некорректные значения отклоняются до обращения к БД
+    try:
+        account_ids_list = [int(x) for x in account_ids.split(',')] if account_ids else None
+        category_ids_list = [int(x) for x in category_ids.split(',')] if category_ids else None
+        tag_ids_list = [int(x) for x in tag_ids.split(',')] if tag_ids else None
+        transaction_types_list = (
+            [TransactionType(x).value for x in transaction_types.split(',')] if transaction_types else None
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Некорректный фильтр: {str(e)}")
+
+    filters = (
+        bool(q), start_date is not None, end_date is not None,
+        min_amount is not None, max_amount is not None,
+        bool(account_ids_list), bool(category_ids_list), bool(transaction_types_list), bool(tag_ids_list)
+    )
+    count_params = {
+        "search_query": f"%{q}%" if q else None,
+        "start_date": start_date,
+        "end_date": end_date,
+        "min_amount": min_amount,
+        "max_amount": max_amount,
+        "account_ids": account_ids_list,
+        "category_ids": category_ids_list,
+        "transaction_types": transaction_types_list,
+        "tag_ids": tag_ids_list
+    }
+    params = {**count_params, "limit": limit, "offset": offset}
+    if cursor:
+        params.update(parse_cursor(cursor), offset=0)
+
+    transactions = (await db.execute(_search_page_query(bool(cursor), *filters), params)).mappings().all()
+
+    # С курсором клиенту достаточно has_more; для offset total берется из кэша
+    if cursor:
+        total_count = None
+    else:
+        cache_key = (
+            q, start_date, end_date, min_amount, max_amount,
+            tuple(sorted(account_ids_list or ())),
+            tuple(sorted(category_ids_list or ())),
+            tuple(sorted(tag_ids_list or ())),
+            tuple(sorted(transaction_types_list or ())),
+        )
+        total_count = search_count_cache.get(cache_key)
+        if total_count is None:
+            total_count = (await db.execute(_search_count_query(*filters), count_params)).scalar()
+            search_count_cache[cache_key] = total_count
+
+    has_more = len(transactions) == limit
+    next_cursor = encode_cursor(transactions[-1]["date"], transactions[-1]["id"]) if has_more else None
 
     return {
         "transactions": transactions,
         "total": total_count,
         "limit": limit,
-        "offset": offset
+        "offset": offset,
+        "next_cursor": next_cursor,
+        "has_more": has_more
     }
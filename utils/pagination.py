@@ -0,0 +1,19 @@
+import base64
+from datetime import date
+from typing import Tuple
+
+
+def encode_cursor(cursor_date: date, cursor_id: int) -> str:
+    """Непрозрачный курсор keyset-пагинации: base64 от "дата:id" последней строки"""
+    raw = f"{cursor_date.isoformat()}:{cursor_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[date, int]:
+    """Обратное к encode_cursor; ValueError для некорректного курсора"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        cursor_date, cursor_id = raw.split(":")
+        return date.fromisoformat(cursor_date), int(cursor_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Некорректный курсор: {cursor}") from e
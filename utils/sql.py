@@ -0,0 +1,19 @@
+from functools import lru_cache
+from typing import Tuple
+from sqlalchemy import text
+from sqlalchemy.sql.elements import TextClause
+
+
+@lru_cache(maxsize=256)
+def build_update_query(table: str, fields: Tuple[str, ...], touch_updated_at: bool = False) -> TextClause:
+    """UPDATE по набору полей; text() собирается один раз на каждую комбинацию полей"""
+    assignments = [f"{field} = :{field}" for field in fields]
+    if touch_updated_at:
+        assignments.append("updated_at = CURRENT_TIMESTAMP")
+
+    return text(f"""
+        UPDATE {table}
+        SET {', '.join(assignments)}
+        WHERE id = :id
+        RETURNING *
+    """)